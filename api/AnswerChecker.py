@@ -1,41 +1,247 @@
 from pydantic import BaseModel
+from typing import List
 import os
-from openai import OpenAI
+import re
+import time
+import llm_gateway
+import asyncio
 from dotenv import load_dotenv
+import metrics
 load_dotenv()
 
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
-client = OpenAI()
 
 class AnswerCheckerResponseFormat(BaseModel):
     short_reason: str
     correct: bool
+    confidence: float
 
-def isCorrectOpenEndedAnswer(answer, correct_answer, explanation):
+class BatchAnswerVerdict(BaseModel):
+    index: int
+    short_reason: str
+    correct: bool
+    confidence: float
+
+class BatchAnswerCheckerResponseFormat(BaseModel):
+    verdicts: List[BatchAnswerVerdict]
+
+# Grading tries the fast model first and escalates to the strong model when
+# the fast model is not confident enough or the answer is long
+FAST_GRADING_MODEL = os.getenv("GRADING_FAST_MODEL", "gpt-4o-mini")
+STRONG_GRADING_MODEL = os.getenv("GRADING_STRONG_MODEL", "gpt-4o")
+ESCALATION_CONFIDENCE = float(os.getenv("GRADING_ESCALATION_CONFIDENCE", "0.8"))
+ESCALATION_ANSWER_LENGTH = int(os.getenv("GRADING_ESCALATION_ANSWER_LENGTH", "600"))
+
+# USD per million input and output tokens, used for the per-tier cost metrics
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+SYSTEM_PROMPT = "You are an assistant that determines if a student's answer is correct based on the reference answer and explanation provided. If the answer is blank or incorrect, you should return False. If the answer is correct, you should return True. Provide a short reason for your decision. Don't overly rely on the reference answer. For example, if the answer requires an example consider if it works for the answer even if it's different. Also give your confidence in the decision from 0 to 1."
+
+BATCH_SYSTEM_PROMPT = "You are an assistant that determines if each of a student's answers is correct based on the reference answer and explanation provided with it. Grade every answer independently. If an answer is blank or incorrect, mark it False. If an answer is correct, mark it True. Provide a short reason for each decision. Don't overly rely on the reference answer. For example, if the answer requires an example consider if it works for the answer even if it's different. Also give your confidence in each decision from 0 to 1. Return exactly one verdict per answer using the answer's index."
+
+BLANK_ANSWER = "**THIS STUDENT LEFT A BLANK ANSWER IT IS INCORRECT**"
+
+# Lowercases and collapses whitespace and punctuation so trivially different
+# spellings of the same answer compare equal. Math operators, parentheses and
+# percent signs are kept as their own tokens so "a+b" and "a-b" stay apart.
+def normalizeAnswer(answer):
+    answer = re.sub(r"(?<=\d),(?=\d{3})", "", answer.lower())
+    answer = re.sub(r"[^\w\s.\-+*/^=<>%()]", " ", answer)
+    answer = re.sub(r"\.(?!\d)", " ", answer)
+    # A hyphen between words joins them ("well-known"), anywhere else it is
+    # a minus, kept on the number when it is a sign ("-6")
+    answer = re.sub(r"(?<=[^\W\d_]{2})-(?=[^\W\d_]{2})", " ", answer)
+    answer = re.sub(r"(?:(?<=^)|(?<=[\s(+*/^=<>]))-(?=\.?\d)", "\x00", answer)
+    answer = re.sub(r"([+*/^=<>%()-])", r" \1 ", answer)
+    return " ".join(answer.replace("\x00", "-").split())
+
+# References with more words than this are never graded locally
+MAX_LOCAL_REFERENCE_WORDS = int(os.getenv("GRADING_MAX_LOCAL_REFERENCE_WORDS", "4"))
+
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?|-?\.\d+")
+
+# Returns the single number in a normalized answer, as text, and the answer's
+# words with the number replaced by "#", or None, None when there isn't
+# exactly one number
+def parseNumericAnswer(normalized):
+    numbers = NUMBER_PATTERN.findall(normalized)
+    if len(numbers) != 1:
+        return None, None
+    return numbers[0], NUMBER_PATTERN.sub(" # ", normalized).split()
+
+# Half a unit in the last decimal place the reference is written with, so
+# integers have to match exactly and "3.14" accepts "3.1416"
+def precisionTolerance(number):
+    decimals = len(number.split(".")[1]) if "." in number else 0
+    return 0.5 * 10 ** -decimals if decimals else 0.0
+
+# Grades an open-ended answer without calling the model when the verdict is
+# certain. Returns True or False, or None when the model has to decide.
+def preGradeOpenEndedAnswer(answer, correct_answer, rubric=None):
+    rubric = rubric or {}
+    if len(answer.strip()) == 0:
+        metrics.incr("grading.local.blank")
+        return False
+
+    normalized_answer = normalizeAnswer(answer)
+    normalized_reference = normalizeAnswer(correct_answer)
+    if len(normalized_answer) == 0:
+        metrics.incr("grading.local.blank")
+        return False
+    if normalized_answer == normalized_reference:
+        metrics.incr("grading.local.exact")
+        return True
+    if normalized_answer in [normalizeAnswer(accepted) for accepted in rubric.get("accepted_answers", [])]:
+        metrics.incr("grading.local.accepted")
+        return True
+
+    # Numbers are only compared when everything around them is the same, so
+    # units, scale ("50%" may mean "0.5") and qualifiers ("x < 5", "not 5",
+    # "n^2") can't be dropped or changed. Anything else goes to the model.
+    answer_number, answer_template = parseNumericAnswer(normalized_answer)
+    reference_number, reference_template = parseNumericAnswer(normalized_reference)
+    if answer_number is None or reference_number is None or answer_template != reference_template:
+        metrics.incr("grading.local.unsure")
+        return None
+    if "numeric_answer" not in rubric and len(reference_template) > MAX_LOCAL_REFERENCE_WORDS:
+        metrics.incr("grading.local.unsure")
+        return None
+
+    # A loose tolerance only when the rubric gives one, which is absolute
+    reference_value = float(rubric.get("numeric_answer", reference_number))
+    tolerance = float(rubric.get("numeric_tolerance") or 0) or precisionTolerance(reference_number)
+    metrics.incr("grading.local.numeric")
+    return abs(float(answer_number) - reference_value) <= tolerance
+
+def formatAnswerForGrading(answer, correct_answer, explanation, rubric=None):
+    content = f"Student Answer: {answer if len(answer) > 0 else BLANK_ANSWER}\n\rReference Answer: {correct_answer}\n\nExplanation: {explanation}"
+    if rubric:
+        if rubric.get("key_points"):
+            content += "\n\nKey Points: " + "; ".join(rubric["key_points"])
+        if rubric.get("accepted_answers"):
+            content += "\n\nAlso Accepted: " + "; ".join(rubric["accepted_answers"])
+    return content
+
+async def parseWithModel(model, messages, response_format):
+    start = time.time()
+    response = await llm_gateway.acall(
+        model,
+        llm_gateway.async_client.beta.chat.completions.parse,
+        model=model,
+        messages=messages,
+        response_format=response_format
+    )
+    metrics.incr(f"grading.tier.{model}.calls")
+    metrics.observe(f"grading.tier.{model}.latency", time.time() - start)
+    if response.usage is not None:
+        input_price, output_price = MODEL_PRICES.get(model, (0, 0))
+        metrics.incr(f"grading.tier.{model}.prompt_tokens", response.usage.prompt_tokens)
+        metrics.incr(f"grading.tier.{model}.completion_tokens", response.usage.completion_tokens)
+        metrics.incr(
+            f"grading.tier.{model}.cost_usd",
+            (response.usage.prompt_tokens * input_price + response.usage.completion_tokens * output_price) / 1e6,
+        )
+    return response.choices[0].message.parsed
+
+def needsStrongModel(answer):
+    return len(answer) > ESCALATION_ANSWER_LENGTH
+
+# Grades with the model cascade only, callers that already ran the local
+# pre-grader use this directly
+async def checkOpenEndedAnswerWithModel(answer, correct_answer, explanation, rubric=None):
     messages = [
         {
             "role": "system",
-            "content": (
-                "You are an assistant that determines if a student's answer is correct based on the reference answer and explanation provided. If the answer is blank or incorrect, you should return False. If the answer is correct, you should return True. Provide a short reason for your decision. Don't overly rely on the reference answer. For example, if the answer requires an example consider if it works for the answer even if it's different." 
-            ),
+            "content": SYSTEM_PROMPT,
         },
         {
             "role": "user",
-            "content": f"Student Answer: {answer if len(answer) > 0 else '**THIS STUDENT LEFT A BLANK ANSWER IT IS INCORRECT**'}\n\rReference Answer: {correct_answer}\n\nExplanation: {explanation}",
+            "content": formatAnswerForGrading(answer, correct_answer, explanation, rubric),
         },
     ]
 
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o",
-        messages=messages,
-        response_format=AnswerCheckerResponseFormat
+    if not needsStrongModel(answer):
+        parsed = await parseWithModel(FAST_GRADING_MODEL, messages, AnswerCheckerResponseFormat)
+        if parsed.confidence >= ESCALATION_CONFIDENCE:
+            print(parsed.short_reason)
+            return parsed.correct
+        metrics.incr(f"grading.tier.{FAST_GRADING_MODEL}.escalations")
+
+    parsed = await parseWithModel(STRONG_GRADING_MODEL, messages, AnswerCheckerResponseFormat)
+    print(parsed.short_reason)
+    return parsed.correct
+
+async def isCorrectOpenEndedAnswer(answer, correct_answer, explanation, rubric=None):
+    isCorrect = preGradeOpenEndedAnswer(answer, correct_answer, rubric)
+    if isCorrect is not None:
+        return isCorrect
+    return await checkOpenEndedAnswerWithModel(answer, correct_answer, explanation, rubric)
+
+async def gradeBatchWithModel(model, items):
+    answers = "\n\n".join(
+        f"### Answer {i}\n{formatAnswerForGrading(*item)}"
+        for i, item in enumerate(items)
     )
-    print(response.choices[0].message.parsed.short_reason)
-    isCorrect = response.choices[0].message.parsed.correct
-    return isCorrect
+    messages = [
+        {
+            "role": "system",
+            "content": BATCH_SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": answers,
+        },
+    ]
+
+    parsed = await parseWithModel(model, messages, BatchAnswerCheckerResponseFormat)
+    if parsed is None:
+        raise ValueError("Batch grading response could not be parsed")
+
+    verdicts = {}
+    for verdict in parsed.verdicts:
+        if verdict.index < 0 or verdict.index >= len(items) or verdict.index in verdicts:
+            raise ValueError(f"Batch grading returned an unexpected index {verdict.index}")
+        verdicts[verdict.index] = verdict
+    if len(verdicts) != len(items):
+        raise ValueError(f"Batch grading returned {len(verdicts)} verdicts for {len(items)} answers")
+    return [verdicts[i] for i in range(len(items))]
+
+# Grades several answers in one request per model tier. items is a list of
+# (answer, correct_answer, explanation) or (answer, correct_answer,
+# explanation, rubric) and the result is a list of
+# (correct, short_reason) in the same order. Low confidence verdicts and long
+# answers are regraded together in one strong model request. Raises
+# ValueError if the model does not return exactly one verdict per item.
+async def gradeOpenEndedAnswers(items):
+    if len(items) == 0:
+        return []
+
+    results = [None] * len(items)
+    escalated = [i for i, item in enumerate(items) if needsStrongModel(item[0])]
+    fast = [i for i in range(len(items)) if not needsStrongModel(items[i][0])]
+    if len(fast) > 0:
+        verdicts = await gradeBatchWithModel(FAST_GRADING_MODEL, [items[i] for i in fast])
+        for i, verdict in zip(fast, verdicts):
+            if verdict.confidence >= ESCALATION_CONFIDENCE:
+                results[i] = (verdict.correct, verdict.short_reason)
+            else:
+                escalated.append(i)
+                metrics.incr(f"grading.tier.{FAST_GRADING_MODEL}.escalations")
+
+    if len(escalated) > 0:
+        verdicts = await gradeBatchWithModel(STRONG_GRADING_MODEL, [items[i] for i in escalated])
+        for i, verdict in zip(escalated, verdicts):
+            results[i] = (verdict.correct, verdict.short_reason)
+
+    for _, reason in results:
+        print(reason)
+    return results
 
 if __name__ == "__main__":
     answer = "Paris"
     correct_answer = "Paris"
     explanation = "Paris is the capital of France."
-    print(isCorrectOpenEndedAnswer(answer, correct_answer, explanation))
+    print(asyncio.run(isCorrectOpenEndedAnswer(answer, correct_answer, explanation)))
@@ -15,6 +15,7 @@ You are an AI exam creator tasked with generating a challenging and educational
    - **Never list the options to a multiple choice in the actual questions, only in the answer_choices field.**
    - **The question should always be relevant to the field/subject**. For example, if the question is about linear algebra don't say something like an analysis was done or a study was conducted.
    - have a wide variety of question styles
+   - For open-ended questions, also provide a grading rubric: `key_points` a correct answer must contain, `accepted_answers` listing other acceptable spellings, synonyms or equivalent forms of a short answer, and `numeric_answer` with `numeric_tolerance` when the answer is a single number.
 
 **Few-Shot Examples:**
 
@@ -108,7 +109,13 @@ createQuestion({
     "question": "Discuss the impact of the Treaty of Versailles on the political and economic landscape of Germany in the interwar period. How did it contribute to the rise of extremist movements?",
     "type": "oe",
     "correct_answer": "The Treaty of Versailles imposed harsh reparations and territorial losses on Germany after World War I. The economic strain from reparations led to hyperinflation and unemployment, causing widespread discontent among the German populace. Politically, the treaty was seen as a 'Diktat' and fostered feelings of humiliation and resentment. These conditions undermined the legitimacy of the Weimar Republic and contributed to the rise of extremist movements, such as the Nazi Party, which capitalized on public discontent by promising to restore Germany's former glory and overturn the treaty's provisions.",
-    "answer_explanation": "The treaty's punitive measures destabilized Germany economically and politically, creating fertile ground for extremist ideologies that ultimately led to significant historical consequences."
+    "answer_explanation": "The treaty's punitive measures destabilized Germany economically and politically, creating fertile ground for extremist ideologies that ultimately led to significant historical consequences.",
+    "key_points": [
+        "Reparations and territorial losses",
+        "Economic strain such as hyperinflation and unemployment",
+        "Humiliation and resentment undermining the Weimar Republic",
+        "Extremist movements like the Nazi Party exploiting discontent"
+    ]
 })
 
 createQuestion({
@@ -1,9 +1,12 @@
 # exam_maker_agent.py
 
 import os
-from openai import OpenAI
+import llm_gateway
+import assistant_registry
+from file_cache import file_cache
 import json
 from dotenv import load_dotenv
+from run_poller import execute_run
 from Prompt import search_prompt_instructions
 
 load_dotenv()
@@ -26,8 +29,10 @@ model = "gpt-4o-mini"
 
 class Agent:
     def __init__(self):
-        self.client = OpenAI()
-        self.agent = self.client.beta.assistants.create(
+        self.client = llm_gateway.client
+        # Reuses the assistant with this exact configuration if one exists
+        self.assistant_id = assistant_registry.get_assistant_id(
+            self.client,
             name="Class Material Search Agent",
             instructions=search_prompt_instructions,
             tools=[
@@ -65,65 +70,61 @@ class Agent:
                 "attachments": [{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids],
             }
         ]
-        thread = self.client.beta.threads.create(messages=messages)
+        thread = llm_gateway.call("assistants", self.client.beta.threads.create, idempotent=False, messages=messages)
         return thread.id
 
-    def run_agent(self, threadId):
+    # on_search_query(query) is called as soon as the assistant adds a query
+    # and returns False once no more queries are wanted. The run is cancelled
+    # as soon as should_stop() returns True.
+    def run_agent(self, threadId, on_search_query=None, should_stop=None):
         data = {
             "search_queries": []
         }
 
-        # create run for assistant
-        run = self.client.beta.threads.runs.create(
-            thread_id=threadId,
-            assistant_id=self.agent.id
-        )
-
-        # retrieve status of run
-        while run.status in ["queued", "in_progress", "requires_action"]:
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=threadId,
-                run_id=run.id
-            )
-            if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
-                toolCalls = run.required_action.submit_tool_outputs.tool_calls
-                toolOutputs = []
-                print(toolCalls)
-
-                for toolCall in toolCalls:
-                    try:
-                        if toolCall.function.name == "AddSearchQuery":
-                            if toolCall.function.arguments:
-                                args = json.loads(toolCall.function.arguments)
-                                print("agent args", args)
-
-                                data["search_queries"].append(args["search_query"]) 
-                                print("agent data", data)
-                                
-
-                                # Do something with args
-                                toolOutputs.append({
-                                    "tool_call_id": toolCall.id,
-                                    "output": "success"
-                                })
-                            else:
-                                toolOutputs.append({
-                                    "tool_call_id": toolCall.id,
-                                    "output": "no arguments provided"
-                                })
-                    except Exception as e:
-                        toolOutputs.append({
-                            "tool_call_id": toolCall.id,
-                            "output": str(e)
-                        })
-
-                run = self.client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=threadId,
-                    run_id=run.id,
-                    tool_outputs=toolOutputs
-                )
-
-        messages = self.client.beta.threads.messages.list(
+        def handle_tool_calls(toolCalls):
+            toolOutputs = []
+            print(toolCalls)
+
+            for toolCall in toolCalls:
+                try:
+                    if toolCall.function.name == "AddSearchQuery":
+                        if toolCall.function.arguments:
+                            args = json.loads(toolCall.function.arguments)
+                            print("agent args", args)
+
+                            data["search_queries"].append(args["search_query"]) 
+                            print("agent data", data)
+                            wanted = on_search_query(args["search_query"]) if on_search_query else True
+
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "success" if wanted is not False else "enough search queries were added, stop adding more"
+                            })
+                        else:
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "no arguments provided"
+                            })
+                except Exception as e:
+                    toolOutputs.append({
+                        "tool_call_id": toolCall.id,
+                        "output": str(e)
+                    })
+            return toolOutputs
+
+        def run(assistant_id):
+            self.assistant_id = assistant_id
+            execute_run(self.client, threadId, assistant_id, handle_tool_calls, "search_query", model, should_stop=should_stop)
+
+        # run the assistant, answering its tool calls until it finishes
+        assistant_registry.call_with_assistant(self.client, self.assistant_id, run)
+        if should_stop and should_stop():
+            print(data)
+            return data
+
+        messages = llm_gateway.call(
+            "assistants",
+            self.client.beta.threads.messages.list,
             thread_id=threadId,
             order="asc"
         )
@@ -134,13 +135,9 @@ class Agent:
         return data
 
     def delete_thread(self, threadId):
-        self.client.beta.threads.delete(threadId) 
+        llm_gateway.call("assistants", self.client.beta.threads.delete, threadId)
 
+    # Materials uploaded before are reused by content hash, the rest are
+    # uploaded in parallel
     def add_files(self, files):
-        file_ids = []
-        for file in files:
-            # print(filename)
-            # print(file_obj)
-            file_response = self.client.files.create(file=file, purpose="assistants")
-            file_ids.append(file_response.id)
-        return file_ids
\ No newline at end of file
+        return file_cache.upload_files(self.client, files)
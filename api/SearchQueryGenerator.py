@@ -1,13 +1,10 @@
-from openai import OpenAI
+import llm_gateway
 from pydantic import BaseModel
 from typing import List
 import os
 import json
 import SearchQueryAgent
 
-# Initialize OpenAI client
-openai_client = OpenAI()
-openai_client.api_key = os.getenv("OPENAI_API_KEY")
 
 class SearchQueryResponseFormat(BaseModel):
     search_queries: List[str]
@@ -40,16 +37,24 @@ Remove any irrelevant files (Schedules, Syllabus, Different subject, Different s
 ** IF THE FILE IS NOT OBVIOUSLY RELEVANT REMOVE IT **
 """
 
-def generate_search_queries(files, class_name, school, topics):
+# on_search_query(query) gets every query as soon as it is generated and
+# generation is cancelled once should_stop() returns True, see
+# SearchQueryAgent.run_agent
+def generate_search_queries(files, class_name, school, topics, on_search_query=None, should_stop=None):
     threadId = search_query_agent.create_conversation(files, class_name, school, topics)
-    data = search_query_agent.run_agent(threadId)
+    try:
+        data = search_query_agent.run_agent(threadId, on_search_query, should_stop)
+    finally:
+        search_query_agent.delete_thread(threadId)
     search_queries = data["search_queries"]
     print("generate_search_queries", search_queries)
     return search_queries
 
 
-def filter_file_names(files, search_queries):
-    response = openai_client.beta.chat.completions.parse(
+async def filter_file_names(files, search_queries):
+    response = await llm_gateway.acall(
+        "gpt-4o-mini",
+        llm_gateway.async_client.beta.chat.completions.parse,
         messages=[{"role": "user", "content": second_prompt.format(files=files, search_queries=search_queries)}],
         model="gpt-4o-mini",
         max_tokens=200,
@@ -1,13 +1,15 @@
-from fastapi import FastAPI, UploadFile, File, Request, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, Request, HTTPException, Form, BackgroundTasks
 import uvicorn
-from exam_maker_agent import Agent
+from exam_maker_agent import Agent, EXAM_SHARDS, direct_materials
 import tempfile
 import shutil
 from fastapi.middleware.cors import CORSMiddleware
 import boto3
-from AnswerChecker import isCorrectOpenEndedAnswer
+from grading import grade_answers, grade_answer_in_background, iter_grades
+import metrics
 import bcrypt
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import stripe
 import os
 from dotenv import load_dotenv
@@ -20,7 +22,15 @@ import json
 from typing import List, Tuple
 import aiohttp  # Added for asynchronous HTTP requests
 import asyncio  # Added for asynchronous operations
+import threading
 from SearchQueryGenerator import generate_search_queries, filter_file_names
+from file_ranker import rank_files, is_relevant, FILE_RANK_LLM_RERANK
+from offload import run_blocking
+from exam_jobs import ExamJobQueue
+from exam_scheduler import ExamScheduler, SchedulerFullError
+from exam_pool import ExamPool
+from question_bank import QuestionBanks, course_key
+from material_selection import select_materials
 
 load_dotenv()
 
@@ -62,6 +72,17 @@ credits_for_tier = {
     "diamond": 6,
 }
 
+# Limits concurrent exam generations and orders waiting ones by tier
+exam_scheduler = ExamScheduler()
+
+# Fingerprints of the questions each user already has per course
+question_banks = QuestionBanks()
+
+
+def user_tier_of(item):
+    tier = item.get("tier", "free") if item else "free"
+    return tier if tier in credits_for_tier else "free"
+
 
 def create_user(
     email, password, tier, stripe_customer_id=None, is_google_account=False
@@ -209,16 +230,12 @@ def test_create_exam_response(user_id):
     return response
 
 
-@app.post("/create_exam/{user_id}")
-async def create_exam(
-    files: List[UploadFile] = File(default=None),
-    user_id: str = None,
-    class_name: str = Form(default=None),
-    school: str = Form(default=None),
-    topics: str = Form(default=None),
-):
+NOT_ENOUGH_CREDITS_MESSAGE = "You do not have enough exam credits. They will reset next Sunday."
+
 
-    # get number of exams user has to get an id
+# Fetches the user and takes one exam credit. Returns the user item (None
+# for unknown users) and an error message when the user has no credits left.
+def claim_exam_credit(user_id):
     response = user_table.get_item(Key={"username": user_id})
     item = response.get("Item")
     if item:
@@ -226,9 +243,7 @@ async def create_exam(
         exam_credits = item.get("exam_credits")
         print("exam_credits", exam_credits)
         if exam_credits < 1:
-            return {
-                "message": "You do not have enough exam credits. They will reset next Sunday."
-            }
+            return item, NOT_ENOUGH_CREDITS_MESSAGE
 
         # decrement exam credits
         user_table.update_item(
@@ -236,52 +251,93 @@ async def create_exam(
             UpdateExpression="SET exam_credits = exam_credits - :val",
             ExpressionAttributeValues={":val": 1},
         )
-        past_exams = item.get("exams")
-
-    if os.getenv("ENV") == "dev":
-        return test_create_exam_response(user_id)
+    return item, None
 
-    # Process files
-    file_list = []
-    if files:
-        file_list = [(file.filename, file.file) for file in files]
 
+async def gather_materials(file_list, class_name, school, topics):
     # Fetch additional materials based on class_name, school, and topics
-    
     if (class_name != "" or school != "" or topics != "") and len(file_list) == 0:
         additional_materials = await fetch_additional_materials(file_list, class_name, school, topics)
     else:
-        additional_materials= []
-    # print(f"Additional materials: {type(additional_materials[0][0]), type(additional_materials[0][1])}")
-    # print(f"File List: {type(file_list[0][0]), type(file_list[0][1])}")
-
+        additional_materials = []
 
     # Combine files and additional materials
-    all_materials = file_list + additional_materials
-    # print("file list", [file.filename for file in files])
-    # print("additional materials", [file for file, _ in additional_materials])
-
-    # Create agent conversation with all materials
-    threadId = agent.create_conversation(all_materials, past_exams, class_name, school, topics)
-    data = agent.run_agent(
-        threadId
+    return file_list + additional_materials
+
+
+# Gives back the credit taken by claim_exam_credit
+def refund_exam_credit(user_id):
+    user_table.update_item(
+        Key={"username": user_id},
+        UpdateExpression="SET exam_credits = exam_credits + :val",
+        ExpressionAttributeValues={":val": 1},
     )
-    agent.delete_thread(threadId)
 
+
+# file_list is the user's uploads, materials are searched for when it is
+# empty. on_event(kind, value) is called with ("gathering", None) and
+# ("materials", count) around gathering the materials, then from a worker
+# thread with ("exam_name", name) and ("question", question) as the assistant
+# produces them. Raises SchedulerFullError when can_shed is set and
+# generation is at capacity, before any materials are gathered. Uploads are
+# kept out of the course's shared vector store.
+async def generate_exam(user_id, tier, file_list, past_exams, class_name, school, topics, on_event=None, can_shed=True):
+    owner = user_id if file_list else None
+    data = await generate_exam_data(user_id, tier, file_list, past_exams, class_name, school, topics, on_event, can_shed, owner)
+    data["course"] = course_key(class_name, school)
+    return data
+
+
+async def generate_exam_data(user_id, tier, file_list, past_exams, class_name, school, topics, on_event, can_shed, owner):
+    # Admission comes first so a shed request hasn't paid for searching and
+    # downloading materials
+    async with exam_scheduler.slot(user_id, tier, can_shed):
+        if on_event:
+            on_event("gathering", None)
+        all_materials = await gather_materials(file_list, class_name, school, topics)
+        if on_event:
+            on_event("materials", len(all_materials))
+        # Questions the user already has are rejected during generation
+        # instead of sending the past exams to the model
+        bank = await run_blocking(question_banks.get, user_id, class_name, school, past_exams)
+        check = bank.generation()
+        # Only the parts of the materials relevant to the topics are sent
+        all_materials = await run_blocking(select_materials, all_materials, class_name, topics)
+        # Small materials are inlined into a single call, skipping the
+        # assistant's thread, run and tool call round trips
+        materials = await run_blocking(direct_materials, all_materials)
+        if materials is not None:
+            return await run_blocking(agent.run_direct, materials, class_name, school, topics, on_event, check.is_duplicate)
+        if EXAM_SHARDS > 1:
+            return await run_blocking(agent.run_sharded, all_materials, past_exams, class_name, school, topics, EXAM_SHARDS, on_event, check.is_duplicate, owner)
+        # Create agent conversation with all materials, the Assistants API calls
+        # block so they run in the bounded pool instead of on the event loop
+        threadId = await run_blocking(agent.create_conversation, all_materials, past_exams, class_name, school, topics, owner)
+        try:
+            return await run_blocking(agent.run_agent, threadId, on_event, check.is_duplicate)
+        finally:
+            await run_blocking(agent.delete_thread, threadId)
+
+
+def save_exam(user_id, item, data):
     if item:
         exams = item.get("exams")
         exam_id = len(exams)
     else:
         exam_id = 0
 
-    examName = data["exam_name"]
-    questions = data["questions"]
     response = {
         "id": exam_id,
-        "name": examName,
-        "questions": questions,
+        "name": data["exam_name"],
+        "questions": data["questions"],
         "message": "success",
     }
+    # Remembered so the pool never serves this user the same exam again
+    if data.get("pool_id"):
+        response["pool_id"] = data["pool_id"]
+    # Lets the question bank tell which course the questions belong to
+    if data.get("course"):
+        response["course"] = data["course"]
 
     # add response to database for user in exams field
     user_table.update_item(
@@ -292,8 +348,226 @@ async def create_exam(
             ":response": [response],
         },
     )
+    if data.get("course"):
+        question_banks.record(user_id, data["course"], data["questions"])
     return response
 
+
+@app.post("/create_exam/{user_id}")
+async def create_exam(
+    files: List[UploadFile] = File(default=None),
+    user_id: str = None,
+    class_name: str = Form(default=None),
+    school: str = Form(default=None),
+    topics: str = Form(default=None),
+):
+    item, message = claim_exam_credit(user_id)
+    if message:
+        return {"message": message}
+    past_exams = item.get("exams") if item else []
+
+    if os.getenv("ENV") == "dev":
+        return test_create_exam_response(user_id)
+
+    # Process files
+    file_list = []
+    if files:
+        file_list = [(file.filename, await file.read()) for file in files]
+
+    data = exam_pool.claim(user_id, past_exams, class_name, school, topics) if not file_list else None
+    if data:
+        return save_exam(user_id, item, data)
+
+    try:
+        data = await generate_exam(user_id, user_tier_of(item), file_list, past_exams, class_name, school, topics)
+    except SchedulerFullError as e:
+        if item:
+            refund_exam_credit(user_id)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many exams are being created right now, please try again shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return save_exam(user_id, item, data)
+
+
+# Same as /create_exam but streams newline delimited JSON frames: the exam
+# name and every question as soon as the assistant creates them, then the
+# saved exam, or an error frame
+@app.post("/create_exam_stream/{user_id}")
+async def create_exam_stream(
+    files: List[UploadFile] = File(default=None),
+    user_id: str = None,
+    class_name: str = Form(default=None),
+    school: str = Form(default=None),
+    topics: str = Form(default=None),
+):
+    item, message = claim_exam_credit(user_id)
+    if message:
+        return {"message": message}
+    past_exams = item.get("exams") if item else []
+
+    # Read uploads now, they are closed once this handler returns
+    file_list = []
+    if files:
+        file_list = [(file.filename, await file.read()) for file in files]
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_event(kind, value):
+        if kind in ["exam_name", "question"]:
+            loop.call_soon_threadsafe(events.put_nowait, (kind, value))
+
+    async def produce():
+        try:
+            if os.getenv("ENV") == "dev":
+                response = test_create_exam_response(user_id)
+                on_event("exam_name", response["name"])
+                for question in response["questions"]:
+                    on_event("question", question)
+            else:
+                data = exam_pool.claim(user_id, past_exams, class_name, school, topics) if not file_list else None
+                if data:
+                    on_event("exam_name", data["exam_name"])
+                    for question in data["questions"]:
+                        on_event("question", question)
+                else:
+                    data = await generate_exam(user_id, user_tier_of(item), file_list, past_exams, class_name, school, topics, on_event)
+                response = save_exam(user_id, item, data)
+            await events.put(("exam", response))
+        except SchedulerFullError as e:
+            if item:
+                refund_exam_credit(user_id)
+            await events.put(("error", f"Too many exams are being created right now, please try again in {e.retry_after} seconds."))
+        except Exception as e:
+            print(f"Error creating exam: {e}")
+            await events.put(("error", "Failed to create exam."))
+
+    async def frames():
+        task = asyncio.create_task(produce())
+        question_count = 0
+        while True:
+            kind, value = await events.get()
+            if kind == "exam_name":
+                frame = {"type": "exam_name", "exam_name": value}
+            elif kind == "question":
+                frame = {"type": "question", "index": question_count, "question": value}
+                question_count += 1
+            elif kind == "exam":
+                frame = {"type": "exam", "id": value["id"], "name": value["name"], "message": "success"}
+            else:
+                frame = {"type": "error", "message": value}
+            yield json.dumps(jsonable_encoder(frame)) + "\n"
+            if kind in ["exam", "error"]:
+                break
+        await task
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+
+async def run_exam_job(job, files, progress):
+    user_id = job["user_id"]
+    if os.getenv("ENV") == "dev":
+        return test_create_exam_response(user_id)
+
+    response = await run_blocking(user_table.get_item, Key={"username": user_id})
+    item = response.get("Item")
+    past_exams = item.get("exams") if item else []
+
+    data = exam_pool.claim(user_id, past_exams, job["class_name"], job["school"], job["topics"]) if not files else None
+    if data:
+        progress("saving")
+        return save_exam(user_id, item, data)
+
+    progress("waiting")
+    question_count = 0
+
+    def on_event(kind, value):
+        nonlocal question_count
+        if kind == "gathering":
+            progress("gathering_materials")
+        elif kind == "materials":
+            progress("generating", materials=value, questions=0)
+        elif kind == "question":
+            question_count += 1
+            progress("generating", questions=question_count)
+
+    # Jobs are already off the request path, so they wait for a slot instead of being shed
+    data = await generate_exam(user_id, user_tier_of(item), files, past_exams, job["class_name"], job["school"], job["topics"], on_event, can_shed=False)
+
+    progress("saving")
+    # Read the user again so the exam id accounts for exams saved meanwhile
+    response = await run_blocking(user_table.get_item, Key={"username": user_id})
+    return save_exam(user_id, response.get("Item"), data)
+
+
+# Gives back the credit taken when the job was submitted
+def refund_exam_job_credit(job):
+    if job.get("credit_claimed"):
+        refund_exam_credit(job["user_id"])
+
+
+exam_job_queue = ExamJobQueue(run_exam_job, on_failed=refund_exam_job_credit)
+
+
+# Pre-generated exams are made like any other, as a user of their own that
+# only gets a slot when no real user is waiting
+async def generate_pool_exam(class_name, school, topics):
+    return await generate_exam("exam_pool", "pool", [], [], class_name, school, topics, can_shed=False)
+
+
+exam_pool = ExamPool(generate_pool_exam)
+
+
+@app.on_event("startup")
+async def start_exam_job_queue():
+    await exam_job_queue.start()
+    await exam_pool.start()
+
+
+# Queues an exam generation and returns its job id right away, poll
+# /exam_jobs/{job_id} for the stage and the exam once it is done
+@app.post("/exam_jobs/{user_id}")
+async def submit_exam_job(
+    files: List[UploadFile] = File(default=None),
+    user_id: str = None,
+    class_name: str = Form(default=None),
+    school: str = Form(default=None),
+    topics: str = Form(default=None),
+):
+    item, message = claim_exam_credit(user_id)
+    if message:
+        return {"message": message}
+
+    file_list = []
+    if files:
+        file_list = [(file.filename, await file.read()) for file in files]
+
+    job = await exam_job_queue.submit(
+        {
+            "user_id": user_id,
+            "class_name": class_name,
+            "school": school,
+            "topics": topics,
+            "credit_claimed": item is not None,
+        },
+        file_list,
+    )
+    return {"job_id": job["job_id"], "status": job["status"], "message": "success"}
+
+
+# wait > 0 long polls: the response is held for up to that many seconds
+# until the job changes
+@app.get("/exam_jobs/{job_id}")
+async def read_exam_job(job_id: str, wait: float = 0):
+    job = await exam_job_queue.get(job_id, min(wait, 30))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    fields = ["job_id", "status", "stage", "progress", "result", "error", "created_at", "updated_at"]
+    return {field: job[field] for field in fields if field in job}
+
+
 async def fetch_additional_materials(files, class_name: str, school: str, topics: str) -> List[Tuple[str, bytes]]:
     # Function to generate multiple search queries using GPT-4o-mini
     # and fetch additional materials using Bing Web Search API
@@ -301,16 +575,11 @@ async def fetch_additional_materials(files, class_name: str, school: str, topics
     if not class_name and not school and not topics:
         return []
 
-    # Generate search queries using GPT-4o-mini
-    search_queries = generate_search_queries(files, class_name, school, topics)
-
     # Limit the number of queries to avoid excessive API calls
     MAX_QUERIES = 3
-    search_queries = search_queries[:MAX_QUERIES]
-
-    print(f"Generated search queries: {search_queries}")
-
-    additional_files = []
+    MAX_FILES = 3 if len(files) == 0 else 0
+    if MAX_FILES == 0:
+        return []
 
     # Set up Bing Search API credentials
     api_key = os.getenv("BING_SEARCH_API_KEY")
@@ -343,27 +612,32 @@ async def fetch_additional_materials(files, class_name: str, school: str, topics
             print(f"Exception during Bing API request: {e}")
             return []
 
-        # Extract URLs from search results
+        # Extract downloadable files from search results, keeping each page's
+        # title and snippet for ranking
         webpages = search_results.get("webPages", {}).get("value", [])
-        file_urls = [page.get("url") for page in webpages if page.get("url")]
-
-        # Filter URLs for downloadable files
-        file_urls = [
-            url for url in file_urls if url.lower().endswith(('.pdf', '.ppt', '.pptx', '.doc', '.docx'))
+        pages = [
+            page for page in webpages
+            if page.get("url") and page["url"].lower().endswith(('.pdf', '.ppt', '.pptx', '.doc', '.docx'))
         ]
 
-        print(f"Found {len(file_urls)} files to download for query: '{query}'")
+        print(f"Found {len(pages)} files to download for query: '{query}'")
 
         downloaded_files = []
 
-        async def download_file(session, url):
+        async def download_file(session, page):
+            url = page["url"]
             try:
                 async with session.get(url) as response:
                     if response.status == 200:
                         content = await response.read()
                         filename = url.split("/")[-1].split("?")[0]
                         print(f"Downloaded {filename}")
-                        return (filename, content)
+                        return {
+                            "filename": filename,
+                            "content": content,
+                            "title": page.get("name", ""),
+                            "snippet": page.get("snippet", ""),
+                        }
                     else:
                         print(f"Failed to download {url}, status code {response.status}")
                         return None
@@ -372,33 +646,84 @@ async def fetch_additional_materials(files, class_name: str, school: str, topics
                 return None
 
         tasks = []
-        for url in file_urls:
-            tasks.append(download_file(session, url))
-        files = await asyncio.gather(*tasks)
+        for page in pages:
+            tasks.append(download_file(session, page))
+        downloads = await asyncio.gather(*tasks)
 
         # Filter out None results
-        for file in files:
-            if file:
-                downloaded_files.append(file)
+        for download in downloads:
+            if download:
+                downloaded_files.append(download)
 
         return downloaded_files
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for query in search_queries:
-            tasks.append(fetch_and_download(session, query))
-        results = await asyncio.gather(*tasks)
-
-    # Aggregate all downloaded files
-    for files in results:
-        additional_files.extend(files)
+    # Every query is searched and its files downloaded as soon as the assistant
+    # generates it, until MAX_QUERIES were started or MAX_FILES relevant files
+    # arrived
+    loop = asyncio.get_running_loop()
+    queries = asyncio.Queue()
+    enough = asyncio.Event()
+    # Set once no more queries will be used, cancels the assistant's run
+    stopped = threading.Event()
+    search_queries = []
+    additional_files = []
+    generated = 0
+
+    # Called from the assistant's worker thread, tells it to stop once no
+    # more queries will be used
+    def on_search_query(query):
+        nonlocal generated
+        generated += 1
+        loop.call_soon_threadsafe(queries.put_nowait, query)
+        return generated < MAX_QUERIES and not enough.is_set()
+
+    def on_generated(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to generate search queries: {future.exception()}")
+        queries.put_nowait(None)
+
+    generation = asyncio.ensure_future(run_blocking(generate_search_queries, files, class_name, school, topics, on_search_query, stopped.is_set))
+    generation.add_done_callback(on_generated)
+
+    async def search(session, query):
+        downloaded_files = await fetch_and_download(session, query)
+        additional_files.extend(downloaded_files)
+        candidates = list(additional_files)
+        relevant = await run_blocking(lambda: sum(1 for file in candidates if is_relevant(file, class_name, topics)))
+        if relevant >= MAX_FILES:
+            enough.set()
+
+    async def start_searches(session, searches):
+        while len(searches) < MAX_QUERIES:
+            query = await queries.get()
+            if query is None:
+                break
+            print(f"Generated search query: {query}")
+            search_queries.append(query)
+            searches.append(asyncio.create_task(search(session, query)))
+        if searches:
+            await asyncio.wait(searches)
 
-    relevant_files = filter_file_names([file[0] for file in additional_files], search_queries)
+    async with aiohttp.ClientSession() as session:
+        searches = []
+        pipeline = asyncio.create_task(start_searches(session, searches))
+        stop = asyncio.create_task(enough.wait())
+        try:
+            await asyncio.wait([pipeline, stop], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.set()
+            for task in [pipeline, stop] + searches:
+                task.cancel()
+        await asyncio.gather(pipeline, stop, *searches, return_exceptions=True)
+
+    # Rank locally, the LLM filter only decides borderline files when enabled
+    relevant_files, borderline_files = await run_blocking(rank_files, additional_files, class_name, topics, search_queries)
+    if FILE_RANK_LLM_RERANK and borderline_files:
+        chosen = await filter_file_names([additional_files[i]["filename"] for i in borderline_files], search_queries)
+        relevant_files += [borderline_files[i] for i in chosen if 0 <= i < len(borderline_files)]
 
     # Filter out irrelevant files
-    additional_files = [additional_files[i] for i in relevant_files]
-
-    MAX_FILES = 3 if len(files) == 0 else 0
+    additional_files = [(additional_files[i]["filename"], additional_files[i]["content"]) for i in relevant_files]
     additional_files = additional_files[:MAX_FILES]
 
     print(f"Total additional files downloaded: {len(additional_files)}")
@@ -759,6 +1084,17 @@ async def stripe_webhook(request: Request):
     return JSONResponse(status_code=200, content={"status": "success"})
 
 
+# Prepare detail based on user's tier
+def grade_detail(question, is_correct, user_tier):
+    detail = {}
+    if user_tier in ["gold", "diamond"]:
+        detail["correct"] = is_correct
+        detail["correct_answer"] = question["correct_answer"]
+        if user_tier == "diamond":
+            detail["explanation"] = question["explanation"]
+    return detail
+
+
 @app.post("/grade_quiz")
 async def grade_quiz(payload: dict):
     username = payload["username"]
@@ -776,25 +1112,12 @@ async def grade_quiz(payload: dict):
         total = len(questions)
         details = []
         user_tier = item.get("tier", "free")
-        for i, question in enumerate(questions):
-            answer = answers[str(i)]
-            is_correct = False
-            if question["type"] == "mc":
-                is_correct = answer == question["correct_answer"]
-            elif question["type"] == "oe":
-                is_correct = isCorrectOpenEndedAnswer(
-                    answer, question["correct_answer"], question["explanation"]
-                )
+        # Grade all answers concurrently, open-ended ones fan out to the model
+        verdicts = await grade_answers(questions, answers)
+        for question, is_correct in zip(questions, verdicts):
             if is_correct:
                 correct += 1
-            # Prepare detail based on user's tier
-            detail = {}
-            if user_tier in ["gold", "diamond"]:
-                detail["correct"] = is_correct
-                detail["correct_answer"] = question["correct_answer"]
-                if user_tier == "diamond":
-                    detail["explanation"] = question["explanation"]
-            details.append(detail)
+            details.append(grade_detail(question, is_correct, user_tier))
         response = {"score": correct, "total": total}
         if user_tier in ["gold", "diamond"]:
             response["details"] = details
@@ -803,6 +1126,62 @@ async def grade_quiz(payload: dict):
         return {"message": "User not found"}
 
 
+# Same as /grade_quiz but streams newline delimited JSON: one
+# {"index", "detail"} frame per question as soon as it is graded, then a
+# final {"score", "total"} frame
+@app.post("/grade_quiz_stream")
+async def grade_quiz_stream(payload: dict):
+    username = payload["username"]
+    exam_id = payload["exam_id"]
+    answers = payload["answers"]
+
+    response = user_table.get_item(Key={"username": username})
+    item = response.get("Item")
+    if not item:
+        return {"message": "User not found"}
+
+    questions = item.get("exams")[exam_id]["questions"]
+    user_tier = item.get("tier", "free")
+
+    async def frames():
+        correct = 0
+        async for i, is_correct in iter_grades(questions, answers):
+            if is_correct:
+                correct += 1
+            frame = {"index": i, "detail": grade_detail(questions[i], is_correct, user_tier)}
+            yield json.dumps(frame) + "\n"
+        yield json.dumps({"score": correct, "total": len(questions)}) + "\n"
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+
+@app.post("/grade_answer")
+async def grade_answer(payload: dict, background_tasks: BackgroundTasks):
+    username = payload["username"]
+    exam_id = payload["exam_id"]
+    question_index = int(payload["question_index"])
+    answer = payload["answer"]
+
+    response = user_table.get_item(Key={"username": username})
+    item = response.get("Item")
+    if item:
+        questions = item.get("exams")[exam_id]["questions"]
+        if question_index < 0 or question_index >= len(questions):
+            raise HTTPException(status_code=400, detail="Invalid question index.")
+        # Grade after responding, /grade_quiz picks the verdict up from the cache
+        background_tasks.add_task(
+            grade_answer_in_background, questions[question_index], answer
+        )
+        return {"message": "accepted"}
+    else:
+        return {"message": "User not found"}
+
+
+@app.get("/metrics")
+async def read_metrics():
+    return metrics.snapshot()
+
+
 # Wrap the FastAPI app with Mangum
 # handler = Mangum(app, lifespan="off")
 
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import openai
+import llm_gateway
+
+# Finds or creates the assistant for a given configuration instead of creating
+# a new one every time a process starts. Assistants are identified by a hash
+# of their configuration, stored in their metadata, and ids are cached in a
+# local JSON file so a warm start makes no network calls. Ship the file with
+# a deployment to skip the lookup on cold starts too. Changing the prompt,
+# tools, model or temperature changes the hash and creates a new assistant.
+# Cached ids are keyed by account too, so one file can serve several API keys
+# or projects, and an id whose assistant was deleted is replaced the first
+# time a run with it fails.
+
+ASSISTANT_REGISTRY_PATH = os.getenv(
+    "ASSISTANT_REGISTRY_PATH", os.path.join(tempfile.gettempdir(), "practicepal_assistants.json")
+)
+
+lock = threading.Lock()
+# Configuration of every id handed out, to look it up again if it goes missing
+configs = {}
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def account_key(client):
+    account = [client.api_key, client.organization, getattr(client, "project", None), str(client.base_url)]
+    return hashlib.sha256(json.dumps(account).encode()).hexdigest()[:16]
+
+
+def load_cache():
+    try:
+        with open(ASSISTANT_REGISTRY_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    tmp_path = ASSISTANT_REGISTRY_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, ASSISTANT_REGISTRY_PATH)
+    except OSError as e:
+        print(f"Failed to save assistant registry: {e}")
+
+
+def find_assistant(client, key):
+    kwargs = {"limit": 100}
+    while True:
+        page = llm_gateway.call("assistants", client.beta.assistants.list, **kwargs)
+        for assistant in page.data:
+            if (assistant.metadata or {}).get("config_hash") == key:
+                return assistant.id
+        if not page.has_more:
+            return None
+        kwargs["after"] = page.data[-1].id
+
+
+# get_assistant_id(client, name=..., instructions=..., tools=..., model=...,
+# temperature=...) takes the same arguments as assistants.create
+def get_assistant_id(client, **config):
+    key = config_hash(config)
+    cache_key = f"{account_key(client)}:{key}"
+    with lock:
+        cache = load_cache()
+        if cache_key in cache:
+            configs[cache[cache_key]] = config
+            return cache[cache_key]
+
+        assistant_id = find_assistant(client, key)
+        if assistant_id is None:
+            assistant = llm_gateway.call(
+                "assistants",
+                client.beta.assistants.create,
+                idempotent=False,
+                metadata={"config_hash": key},
+                **config
+            )
+            assistant_id = assistant.id
+            print(f"Created assistant {config.get('name')} {assistant_id}")
+
+        cache[cache_key] = assistant_id
+        save_cache(cache)
+        configs[assistant_id] = config
+        return assistant_id
+
+
+# Returns the id to use instead of assistant_id when its assistant no longer
+# exists, None when it still does
+def replace_missing(client, assistant_id):
+    config = configs.get(assistant_id)
+    if config is None:
+        return None
+    try:
+        llm_gateway.call("assistants", client.beta.assistants.retrieve, assistant_id)
+        return None
+    except openai.NotFoundError:
+        pass
+    print(f"Assistant {assistant_id} is gone, looking it up again")
+    with lock:
+        cache = load_cache()
+        cache = {key: value for key, value in cache.items() if value != assistant_id}
+        save_cache(cache)
+    return get_assistant_id(client, **config)
+
+
+# Calls fn(assistant_id) and, when it fails with a 404 because the assistant
+# was deleted, once more with the id of a replacement
+def call_with_assistant(client, assistant_id, fn):
+    try:
+        return fn(assistant_id)
+    except openai.NotFoundError:
+        replacement = replace_missing(client, assistant_id)
+        if replacement is None:
+            raise
+    return fn(replacement)
@@ -0,0 +1,88 @@
+# Measures how well the similarity pre-scorer agrees with the model's verdicts.
+#
+# Usage: python calibrate_similarity.py samples.jsonl
+#
+# Each line of samples.jsonl is {"answer", "correct_answer", "explanation"}
+# with an optional "correct" verdict. Samples without one are graded by the
+# model first with checkOpenEndedAnswerWithModel, skipping the local
+# pre-grader, so the output can be reused as a labelled set with --save.
+
+import argparse
+import asyncio
+import json
+import numpy as np
+from AnswerChecker import checkOpenEndedAnswerWithModel
+import similarity_scorer
+
+
+def load_samples(path):
+    samples = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                samples.append(json.loads(line))
+    return samples
+
+
+async def label_all(samples, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def label(sample):
+        async with semaphore:
+            sample["correct"] = await checkOpenEndedAnswerWithModel(
+                sample["answer"], sample["correct_answer"], sample["explanation"]
+            )
+
+    await asyncio.gather(*(label(sample) for sample in samples if "correct" not in sample))
+
+
+# Grades every unlabelled sample on one event loop, at most concurrency at once
+def label_samples(samples, concurrency=8):
+    asyncio.run(label_all(samples, concurrency))
+    return samples
+
+
+# For every threshold, how many answers would be accepted (score >= threshold)
+# or rejected (score <= threshold) and how often the model agrees
+def report(scores, labels, thresholds):
+    total = len(labels)
+    print("threshold  accepted  agree   | rejected  agree")
+    for threshold in thresholds:
+        accepted = scores >= threshold
+        rejected = scores <= threshold
+        accept_agreement = labels[accepted].mean() if accepted.any() else float("nan")
+        reject_agreement = (~labels[rejected]).mean() if rejected.any() else float("nan")
+        print(
+            f"{threshold:9.2f}  {accepted.sum():4d}/{total:<4d} {accept_agreement:6.1%}  | "
+            f"{rejected.sum():4d}/{total:<4d} {reject_agreement:6.1%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("samples")
+    parser.add_argument("--save", help="write the labelled samples to this file")
+    parser.add_argument("--concurrency", type=int, default=8, help="samples graded at once")
+    args = parser.parse_args()
+
+    samples = label_samples(load_samples(args.samples), args.concurrency)
+    if args.save:
+        with open(args.save, "w") as f:
+            for sample in samples:
+                f.write(json.dumps(sample) + "\n")
+
+    scores = similarity_scorer.score_pairs(
+        [sample["answer"] for sample in samples],
+        [sample["correct_answer"] for sample in samples],
+    )
+    labels = np.array([bool(sample["correct"]) for sample in samples])
+    print(f"{len(samples)} samples, {labels.mean():.1%} graded correct by the model")
+    report(scores, labels, np.arange(0.0, 1.0001, 0.05))
+    print(
+        f"Configured: accept >= {similarity_scorer.SIMILARITY_ACCEPT_THRESHOLD}, "
+        f"reject <= {similarity_scorer.SIMILARITY_REJECT_THRESHOLD}"
+    )
+
+
+if __name__ == "__main__":
+    main()
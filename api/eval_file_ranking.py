@@ -0,0 +1,105 @@
+# Compares the local file ranker with the LLM file filter on a labelled set.
+#
+# Usage: python eval_file_ranking.py file_ranking_eval.jsonl [--llm]
+#
+# Each line is a search for one course: {"class_name", "school", "topics",
+# "search_queries", "files"} where every file has "filename", "title",
+# "snippet", "first_page" and whether it is "relevant". Prints the precision
+# and recall of the files each method keeps. --sweep also prints them for a
+# range of FILE_RANK_MIN_COVERAGE cutoffs. --llm also runs filter_file_names,
+# which needs OPENAI_API_KEY.
+
+import argparse
+import asyncio
+import json
+import time
+import file_ranker
+from file_ranker import rank_files, score_files
+
+
+def load_cases(path):
+    cases = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                cases.append(json.loads(line))
+    return cases
+
+
+def local_ranker(case):
+    keep, _ = rank_files(case["files"], case["class_name"], case["topics"], case["search_queries"])
+    return keep
+
+
+# Filters every case on one event loop, the shared async client is bound to it
+def llm_filter_all(cases):
+    from SearchQueryGenerator import filter_file_names
+
+    async def filter_all():
+        return await asyncio.gather(*(
+            filter_file_names([file["filename"] for file in case["files"]], case["search_queries"])
+            for case in cases
+        ))
+
+    results = {}
+    for case, chosen in zip(cases, asyncio.run(filter_all())):
+        results[id(case)] = [i for i in chosen if 0 <= i < len(case["files"])]
+    return lambda case: results[id(case)]
+
+
+def sweep(cases):
+    scored = [(case, score_files(case["files"], case["class_name"], case["topics"], case["search_queries"])) for case in cases]
+    print("cutoff  kept  precision  recall")
+    for step in range(5, 65, 5):
+        cutoff = step / 100
+        kept_total = relevant_kept = relevant_total = 0
+        for case, scores in scored:
+            relevant = {i for i, file in enumerate(case["files"]) if file["relevant"]}
+            kept = {i for i, (coverage, _) in enumerate(scores) if coverage >= cutoff}
+            kept_total += len(kept)
+            relevant_kept += len(kept & relevant)
+            relevant_total += len(relevant)
+        precision = relevant_kept / kept_total if kept_total else float("nan")
+        marker = " <- FILE_RANK_MIN_COVERAGE" if abs(cutoff - file_ranker.FILE_RANK_MIN_COVERAGE) < 1e-9 else ""
+        print(f"{cutoff:6.2f}  {kept_total:4d}  {precision:8.1%}  {relevant_kept / relevant_total:6.1%}{marker}")
+
+
+def evaluate(name, method, cases):
+    kept_total = relevant_kept = relevant_total = 0
+    start = time.time()
+    for case in cases:
+        kept = set(method(case))
+        relevant = {i for i, file in enumerate(case["files"]) if file["relevant"]}
+        kept_total += len(kept)
+        relevant_kept += len(kept & relevant)
+        relevant_total += len(relevant)
+        wrong = [case["files"][i]["filename"] for i in sorted(kept ^ relevant)]
+        if wrong:
+            print(f"  {name} {case['class_name']}: wrong on {wrong}")
+    elapsed = time.time() - start
+    precision = relevant_kept / kept_total if kept_total else float("nan")
+    recall = relevant_kept / relevant_total if relevant_total else float("nan")
+    print(f"{name:6s} precision {precision:6.1%}  recall {recall:6.1%}  {elapsed * 1000 / len(cases):8.1f}ms per search")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases")
+    parser.add_argument("--llm", action="store_true", help="also evaluate the LLM filter")
+    parser.add_argument("--sweep", action="store_true", help="also try a range of coverage cutoffs")
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+    print(f"{len(cases)} searches, {sum(len(case['files']) for case in cases)} files")
+    evaluate("local", local_ranker, cases)
+    if args.sweep:
+        sweep(cases)
+    if args.llm:
+        start = time.time()
+        method = llm_filter_all(cases)
+        print(f"llm filter took {(time.time() - start) * 1000 / len(cases):.0f}ms per search")
+        evaluate("llm", method, cases)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+import boto3
+from boto3.dynamodb.conditions import Attr
+import metrics
+from offload import run_blocking
+
+# Background exam generation. Submitting returns a job id at once, a bounded
+# pool of workers runs the pipeline and the job record tracks its stage so
+# clients can poll for the result. Jobs are kept in DynamoDB when
+# EXAM_JOBS_TABLE is set and in local JSON files otherwise. Uploaded files are
+# always kept on local disk until the job finishes.
+
+EXAM_JOB_WORKERS = int(os.getenv("EXAM_JOB_WORKERS", "2"))
+EXAM_JOBS_TABLE = os.getenv("EXAM_JOBS_TABLE")
+EXAM_JOBS_PATH = os.getenv("EXAM_JOBS_PATH", os.path.join(tempfile.gettempdir(), "practicepal_exam_jobs"))
+# A job whose owner hasn't refreshed its heartbeat for this long is taken over:
+# queued jobs are run again, running jobs are failed
+EXAM_JOB_LEASE = int(os.getenv("EXAM_JOB_LEASE", "120"))
+
+FINISHED_STATUSES = ["done", "failed"]
+
+
+def decimal_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class LocalJobStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.lock_path = os.path.join(path, ".lock")
+
+    # Writes are serialized across threads and across processes sharing
+    # EXAM_JOBS_PATH, a threading lock alone only covers this process
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def job_path(self, job_id):
+        return os.path.join(self.path, f"{job_id}.json")
+
+    def get(self, job_id):
+        try:
+            with open(self.job_path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, job):
+        with self.locked():
+            self.write(job)
+
+    # Callers hold locked()
+    def write(self, job):
+        tmp_path = self.job_path(job["job_id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, default=decimal_default)
+        os.replace(tmp_path, self.job_path(job["job_id"]))
+
+    # Takes over the job if nobody refreshed it since expected_heartbeat, the
+    # check and the new lease are written under one file lock so two
+    # processes can't both take it
+    def claim(self, job, worker_id, expected_heartbeat):
+        with self.locked():
+            current = self.get(job["job_id"])
+            if current is None or current.get("heartbeat_at") != expected_heartbeat:
+                return False
+            job["worker_id"] = worker_id
+            job["heartbeat_at"] = int(time.time())
+            self.write(job)
+        return True
+
+    def list_unfinished(self):
+        jobs = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                job = self.get(name[: -len(".json")])
+                if job and job["status"] not in FINISHED_STATUSES:
+                    jobs.append(job)
+        return jobs
+
+
+class DynamoJobStore:
+    # The table needs a "job_id" partition key
+    def __init__(self, table_name):
+        session = boto3.Session(
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        )
+        self.table = session.resource("dynamodb", region_name="us-east-1").Table(table_name)
+
+    def get(self, job_id):
+        return self.table.get_item(Key={"job_id": job_id}).get("Item")
+
+    def put(self, job):
+        self.table.put_item(Item=json.loads(json.dumps(job, default=decimal_default), parse_float=Decimal))
+
+    def claim(self, job, worker_id, expected_heartbeat):
+        try:
+            self.table.update_item(
+                Key={"job_id": job["job_id"]},
+                UpdateExpression="SET worker_id = :worker_id, heartbeat_at = :now",
+                ConditionExpression=Attr("heartbeat_at").eq(expected_heartbeat),
+                ExpressionAttributeValues={":worker_id": worker_id, ":now": int(time.time())},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        job["worker_id"] = worker_id
+        return True
+
+    def list_unfinished(self):
+        jobs = []
+        kwargs = {"FilterExpression": ~Attr("status").is_in(FINISHED_STATUSES)}
+        while True:
+            response = self.table.scan(**kwargs)
+            jobs.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                return jobs
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+class ExamJobQueue:
+    # run_job(job, files, progress) runs the pipeline and returns the exam,
+    # progress(stage, **fields) reports where it is. on_failed(job) is called
+    # for every job that fails, including ones interrupted by a restart.
+    def __init__(self, run_job, on_failed=None, store=None, workers=EXAM_JOB_WORKERS):
+        self.run_job = run_job
+        self.on_failed = on_failed
+        self.store = store or (DynamoJobStore(EXAM_JOBS_TABLE) if EXAM_JOBS_TABLE else LocalJobStore(EXAM_JOBS_PATH))
+        self.workers = workers
+        self.worker_id = uuid.uuid4().hex
+        self.files_path = os.path.join(EXAM_JOBS_PATH, "files")
+        self.queue = None
+        self.owned = {}
+        self.changed = {}
+        self.locks = {}
+        self.tasks = []
+
+    async def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.maintain()))
+
+    async def submit(self, fields, files):
+        await self.start()
+        now = int(time.time())
+        job = {
+            **fields,
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "stage": "queued",
+            "progress": {},
+            "created_at": now,
+            "updated_at": now,
+            "worker_id": self.worker_id,
+            "heartbeat_at": now,
+        }
+        await run_blocking(self.save_files, job["job_id"], files)
+        await run_blocking(self.store.put, job)
+        self.enqueue(job)
+        return job
+
+    async def get(self, job_id, wait=0):
+        await self.start()
+        job = self.owned.get(job_id) or await run_blocking(self.store.get, job_id)
+        if job is None or wait <= 0 or job["status"] in FINISHED_STATUSES:
+            return job
+        if job_id in self.owned:
+            # Long poll, return as soon as this process updates the job
+            changed = self.changed.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+            return self.owned.get(job_id) or await run_blocking(self.store.get, job_id)
+        await asyncio.sleep(min(wait, 2))
+        return await run_blocking(self.store.get, job_id)
+
+    def enqueue(self, job):
+        self.owned[job["job_id"]] = job
+        self.queue.put_nowait(job)
+        metrics.gauge("exam_jobs.queue_depth", self.queue.qsize())
+
+    async def update(self, job, **fields):
+        # One write at a time per job, run drains progress writes before the
+        # final one so they can't land after it
+        async with self.locks.setdefault(job["job_id"], asyncio.Lock()):
+            job.update(fields)
+            job["updated_at"] = int(time.time())
+            job["heartbeat_at"] = job["updated_at"]
+            await run_blocking(self.store.put, job)
+        changed = self.changed.pop(job["job_id"], None)
+        if changed:
+            changed.set()
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            metrics.gauge("exam_jobs.queue_depth", self.queue.qsize())
+            metrics.observe("exam_jobs.queue_wait", time.time() - job["created_at"])
+            await self.run(job)
+
+    async def run(self, job):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+
+        # Progress writes not yet stored, drained before the final update so
+        # none of them can land after it
+        pending = []
+
+        def progress(stage, **fields):
+            # Called from the event loop or from pipeline worker threads
+            update = self.update(job, stage=stage, progress={**job["progress"], **fields})
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pending.append(asyncio.run_coroutine_threadsafe(update, loop))
+                return
+            pending.append(asyncio.ensure_future(update))
+
+        async def drain():
+            await asyncio.gather(*[asyncio.wrap_future(update) for update in pending], return_exceptions=True)
+
+        try:
+            await self.update(job, status="running", stage="starting")
+            files = await run_blocking(self.load_files, job)
+            result = await self.run_job(job, files, progress)
+            await drain()
+            await self.update(job, status="done", stage="done", result=result)
+            metrics.incr("exam_jobs.done")
+        except Exception as e:
+            print(f"Exam job {job['job_id']} failed: {e}")
+            await drain()
+            await self.fail(job, "Failed to create exam.")
+        finally:
+            metrics.observe("exam_jobs.duration", time.time() - start)
+            self.owned.pop(job["job_id"], None)
+            self.locks.pop(job["job_id"], None)
+            await run_blocking(self.delete_files, job["job_id"])
+
+    async def fail(self, job, error):
+        await self.update(job, status="failed", stage="failed", error=error)
+        metrics.incr("exam_jobs.failed")
+        if self.on_failed:
+            try:
+                await run_blocking(self.on_failed, job)
+            except Exception as e:
+                print(f"Failed to clean up exam job {job['job_id']}: {e}")
+
+    # Refreshes the heartbeat of jobs owned by this process and takes over
+    # jobs left behind by stopped ones
+    async def maintain(self):
+        while True:
+            try:
+                now = int(time.time())
+                for job in list(self.owned.values()):
+                    if now - job["heartbeat_at"] > EXAM_JOB_LEASE // 3:
+                        await self.update(job)
+                for job in await run_blocking(self.store.list_unfinished):
+                    if job["job_id"] in self.owned or now - int(job["heartbeat_at"]) <= EXAM_JOB_LEASE:
+                        continue
+                    if not await run_blocking(self.store.claim, job, self.worker_id, job["heartbeat_at"]):
+                        continue
+                    job["heartbeat_at"] = int(time.time())
+                    if job["status"] == "queued" and os.path.isdir(self.job_files_path(job["job_id"])):
+                        print(f"Resuming exam job {job['job_id']}")
+                        self.enqueue(job)
+                    else:
+                        print(f"Failing interrupted exam job {job['job_id']}")
+                        await self.fail(job, "Exam creation was interrupted, please try again.")
+                        self.locks.pop(job["job_id"], None)
+                        await run_blocking(self.delete_files, job["job_id"])
+            except Exception as e:
+                print(f"Exam job maintenance failed: {e}")
+            await asyncio.sleep(EXAM_JOB_LEASE // 3)
+
+    def job_files_path(self, job_id):
+        return os.path.join(self.files_path, job_id)
+
+    def save_files(self, job_id, files):
+        path = self.job_files_path(job_id)
+        os.makedirs(path, exist_ok=True)
+        for i, (filename, content) in enumerate(files):
+            with open(os.path.join(path, f"{i}_{os.path.basename(filename)}"), "wb") as f:
+                f.write(content)
+
+    def load_files(self, job):
+        path = self.job_files_path(job["job_id"])
+        if not os.path.isdir(path):
+            return []
+        files = []
+        for name in sorted(os.listdir(path), key=lambda name: int(name.split("_", 1)[0])):
+            with open(os.path.join(path, name), "rb") as f:
+                files.append((name.split("_", 1)[1], f.read()))
+        return files
+
+    def delete_files(self, job_id):
+        shutil.rmtree(self.job_files_path(job_id), ignore_errors=True)
@@ -1,10 +1,23 @@
 # exam_maker_agent.py
 
 import os
-from openai import OpenAI
+import re
+import threading
+import llm_gateway
+import assistant_registry
+from file_cache import file_cache, read_content
 import json
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import List, Optional
+from pydantic import BaseModel
 from dotenv import load_dotenv
+import metrics
+from run_poller import execute_run
 from Prompt import prompt_instructions
+from material_selection import SELECTED_FILENAME
+from text_extraction import extract_text
+from vector_stores import VectorStoreManager
 
 load_dotenv()
 
@@ -12,12 +25,184 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
 QUERY_PROMPT = """Generate a new practice exam for "{class_name}" taught at "{school}" on these topics "{topics}" and based on the inputted files."""
 
+SHARD_PROMPT = """Generate part {part} of {parts} of a new practice exam for "{class_name}" taught at "{school}" on these topics "{topics}" and based on the inputted files.
+For this part create exactly {mc} multiple choice (mc) and {oe} open ended (oe) questions, this replaces the number of questions in the instructions. {name_instruction}"""
+
+DIRECT_PROMPT = """Generate a new practice exam for "{class_name}" taught at "{school}" on these topics "{topics}" and based on the class materials below.
+Instead of calling createExamName and createQuestion, return the exam name and every question in the response format. Leave answer_choices empty for open ended questions and the rubric fields empty or null when they don't apply.
+
+Class materials:
+{materials}"""
+
+SELECTED_PROMPT = """
+
+Also use these parts of the class materials, selected for the topics. They are not in the attached files:
+{materials}"""
+
 model = "gpt-4o-mini"
 
+# Number of concurrent runs an exam is split across, 1 generates it in one run
+EXAM_SHARDS = int(os.getenv("EXAM_SHARDS", "1"))
+EXAM_QUESTION_COUNT = 15
+EXAM_MIN_MULTIPLE_CHOICE = 5
+
+# "auto" generates exams with a single structured output call when there are
+# no files or one small file and with the assistant otherwise, "direct" and
+# "assistants" force one of them
+EXAM_MODE = os.getenv("EXAM_MODE", "auto")
+DIRECT_MAX_FILES = int(os.getenv("EXAM_DIRECT_MAX_FILES", "1"))
+# About 10k tokens of extracted text
+DIRECT_MAX_CHARS = int(os.getenv("EXAM_DIRECT_MAX_CHARS", "40000"))
+
+
+class ExamQuestionFormat(BaseModel):
+    question: str
+    type: str
+    answer_choices: List[str]
+    correct_answer: str
+    answer_explanation: str
+    key_points: List[str]
+    accepted_answers: List[str]
+    numeric_answer: Optional[float]
+    numeric_tolerance: Optional[float]
+
+class ExamResponseFormat(BaseModel):
+    exam_name: str
+    questions: List[ExamQuestionFormat]
+
+# Grading rubric stored with open-ended questions so answers can be graded
+# locally or by a cheaper model. Numbers are stored as Decimal for DynamoDB.
+def build_rubric(args):
+    rubric = {}
+    if args.get("key_points"):
+        rubric["key_points"] = [str(point) for point in args["key_points"]]
+    if args.get("accepted_answers"):
+        rubric["accepted_answers"] = [str(answer) for answer in args["accepted_answers"]]
+    if isinstance(args.get("numeric_answer"), (int, float)):
+        rubric["numeric_answer"] = Decimal(str(args["numeric_answer"]))
+        tolerance = args.get("numeric_tolerance")
+        rubric["numeric_tolerance"] = Decimal(str(abs(tolerance))) if isinstance(tolerance, (int, float)) else Decimal("0")
+    return rubric
+
+# Turns createQuestion arguments into the question stored with the exam, None
+# for unsupported types
+def build_question(args):
+    if args["type"] == "mc":
+        return {
+            "question": args["question"],
+            "type": args["type"],
+            "answer_choices": args["answer_choices"],
+            "correct_answer": args["correct_answer"],
+            "explanation": args["answer_explanation"]
+        }
+    if args["type"] == "oe":
+        question = {
+            "question": args["question"],
+            "type": args["type"],
+            "correct_answer": args["correct_answer"],
+            "explanation": args["answer_explanation"]
+        }
+        rubric = build_rubric(args)
+        if rubric:
+            question["rubric"] = rubric
+        return question
+    return None
+
+
+# Returns the text to inline for a direct generation, or None when the
+# materials are too big or can't be read locally and need the assistant.
+# Contents can be bytes or file objects such as uploads.
+def direct_materials(files, mode=None):
+    mode = mode or EXAM_MODE
+    if mode == "assistants" or (mode == "auto" and len(files) > DIRECT_MAX_FILES):
+        return None
+    texts = []
+    for filename, content in files:
+        text = extract_text(filename, read_content(content))
+        if text is None:
+            return None
+        texts.append(f"{filename}:\n{text}")
+    materials = "\n\n".join(texts)
+    if mode == "auto" and len(materials) > DIRECT_MAX_CHARS:
+        return None
+    return materials[:DIRECT_MAX_CHARS]
+
+
+# The text select_materials picked for the request's topics goes into the
+# thread's message instead of being uploaded, it changes with the topics so it
+# would miss the file cache and pollute the course's shared vector store.
+# Returns the text and the other files.
+def split_selected(files):
+    selected = "\n\n".join(content.decode("utf-8") for filename, content in files if filename == SELECTED_FILENAME)
+    return selected, [file for file in files if file[0] != SELECTED_FILENAME]
+
+
+def with_selected(content, selected):
+    return content + SELECTED_PROMPT.format(materials=selected) if selected else content
+
+
+# Splits the exam into shards. Topics are dealt out between the shards when
+# there are enough of them, otherwise every shard covers all topics and only
+# the question slots are split. Returns dicts with topics, mc and oe counts.
+def plan_shards(topics, shards, total=EXAM_QUESTION_COUNT, min_mc=EXAM_MIN_MULTIPLE_CHOICE):
+    shards = max(1, min(shards, total))
+    topic_list = [topic.strip() for topic in re.split(r"[,;\n]", topics or "") if topic.strip()]
+    mc_total = max(min_mc, total // 2)
+    plans = []
+    for i in range(shards):
+        count = total // shards + (1 if i < total % shards else 0)
+        mc = min(count, mc_total // shards + (1 if i < mc_total % shards else 0))
+        if len(topic_list) >= shards:
+            shard_topics = ", ".join(topic_list[i::shards])
+        else:
+            shard_topics = topics if topics else "ANY"
+        plans.append({"topics": shard_topics, "mc": mc, "oe": count - mc})
+    return plans
+
+
+def question_key(question):
+    return " ".join(re.sub(r"[^\w\s]", " ", question["question"].lower()).split())
+
+
+# Collects questions from concurrent shard runs, dropping duplicates and
+# forwarding the kept ones to on_event as they arrive
+class ShardMerger:
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.exam_name = ""
+        self.questions = []
+        self.seen = set()
+
+    def add(self, kind, value):
+        with self.lock:
+            if kind == "exam_name":
+                if self.exam_name:
+                    return
+                self.exam_name = value
+            elif kind == "question":
+                key = question_key(value)
+                if key in self.seen:
+                    return
+                self.seen.add(key)
+                self.questions.append(value)
+        if self.on_event:
+            self.on_event(kind, value)
+
+    def multiple_choice_count(self):
+        with self.lock:
+            return sum(1 for question in self.questions if question["type"] == "mc")
+
+
 class Agent:
     def __init__(self):
-        self.client = OpenAI()
-        self.agent = self.client.beta.assistants.create(
+        self.client = llm_gateway.client
+        self.vector_stores = VectorStoreManager(self.client)
+        # Vector store each thread searches, released when it is deleted
+        self.thread_stores = {}
+        # Reuses the assistant with this exact configuration if one exists
+        self.assistant_id = assistant_registry.get_assistant_id(
+            self.client,
             name="Exam Maker",
             instructions=prompt_instructions,
             tools=[
@@ -50,6 +235,24 @@ class Agent:
                                 "answer_explanation": {
                                     "type": "string",
                                     "description": "an explanation of why the correct answer is correct"
+                                },
+                                "key_points": {
+                                    "type": "array",
+                                    "items": {"type": "string"},
+                                    "description": "for open ended questions, the key points a correct answer must contain"
+                                },
+                                "accepted_answers": {
+                                    "type": "array",
+                                    "items": {"type": "string"},
+                                    "description": "for open ended questions with a short answer, other spellings, synonyms or equivalent forms of the correct answer that should also be accepted"
+                                },
+                                "numeric_answer": {
+                                    "type": "number",
+                                    "description": "for open ended questions whose answer is a single number, that number"
+                                },
+                                "numeric_tolerance": {
+                                    "type": "number",
+                                    "description": "the largest absolute difference from numeric_answer that is still correct"
                                 }
                             },
                             "required": ["question", "type", "correct_answer"]
@@ -79,100 +282,215 @@ class Agent:
             temperature=1.1
         )
 
-    def create_conversation(self, files, past_exams, class_name, school, topics):
+    # owner is the user whose own uploads these are, None for public
+    # materials that can share the course's vector store
+    def create_conversation(self, files, past_exams, class_name, school, topics, owner=None):
         # print(files) 
+        selected, files = split_selected(files)
         file_ids = self.add_files(files)
+        vector_store_id, file_ids = self.vector_stores.resources_for(class_name, school, file_ids, owner)
+        content = QUERY_PROMPT.format(class_name=class_name, school=school, topics=topics if topics != "" else "ANY")
+        content = with_selected(content, selected)
+        try:
+            threadId = self.create_thread(file_ids, content, vector_store_id)
+        except Exception:
+            self.vector_stores.release(vector_store_id)
+            raise
+        self.thread_stores[threadId] = vector_store_id
+        return threadId
+
+    # Files already in the course's vector store are searched through it,
+    # file_ids are attached to the message and embedded for this thread only
+    def create_thread(self, file_ids, content, vector_store_id=None):
         messages = [
             {
                 "role": "user",
-                "content": QUERY_PROMPT.format(class_name=class_name, school=school, topics=topics if topics != "" else "ANY"),
+                "content": content,
                 "attachments": [{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids],
             }
         ]
-        thread = self.client.beta.threads.create(messages=messages)
+        kwargs = {}
+        if vector_store_id:
+            kwargs["tool_resources"] = {"file_search": {"vector_store_ids": [vector_store_id]}}
+        thread = llm_gateway.call("assistants", self.client.beta.threads.create, idempotent=False, messages=messages, **kwargs)
         return thread.id
 
-    def run_agent(self, threadId):
+    def run_shard(self, file_ids, vector_store_id, selected, plan, part, parts, class_name, school, name_exam, on_event, is_duplicate=None):
+        content = SHARD_PROMPT.format(
+            part=part,
+            parts=parts,
+            class_name=class_name,
+            school=school,
+            topics=plan["topics"],
+            mc=plan["mc"],
+            oe=plan["oe"],
+            name_instruction="Also create the exam name." if name_exam else "Do not create an exam name.",
+        )
+        content = with_selected(content, selected)
+        threadId = self.create_thread(file_ids, content, vector_store_id)
+        try:
+            return self.run_agent(threadId, on_event, is_duplicate)
+        finally:
+            self.delete_thread(threadId)
+
+    # Generates the exam with several concurrent runs on the same uploaded
+    # files and merges their questions. Returns the same data as run_agent.
+    def run_sharded(self, files, past_exams, class_name, school, topics, shards=EXAM_SHARDS, on_event=None, is_duplicate=None, owner=None):
+        selected, files = split_selected(files)
+        file_ids = self.add_files(files)
+        vector_store_id, file_ids = self.vector_stores.resources_for(class_name, school, file_ids, owner)
+        try:
+            return self.run_shards(file_ids, vector_store_id, selected, class_name, school, topics, shards, on_event, is_duplicate)
+        finally:
+            self.vector_stores.release(vector_store_id)
+
+    def run_shards(self, file_ids, vector_store_id, selected, class_name, school, topics, shards, on_event, is_duplicate):
+        plans = plan_shards(topics, shards)
+        merger = ShardMerger(on_event)
+
+        with ThreadPoolExecutor(max_workers=len(plans)) as pool:
+            futures = [
+                pool.submit(self.run_shard, file_ids, vector_store_id, selected, plan, i + 1, len(plans), class_name, school, i == 0, merger.add, is_duplicate)
+                for i, plan in enumerate(plans)
+            ]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Exam shard failed: {e}")
+                    errors.append(e)
+            if len(errors) == len(futures):
+                raise errors[0]
+
+        # Failed shards or dropped duplicates can leave too few multiple choice
+        missing = EXAM_MIN_MULTIPLE_CHOICE - merger.multiple_choice_count()
+        if missing > 0:
+            plan = {"topics": topics if topics else "ANY", "mc": missing, "oe": 0}
+            self.run_shard(file_ids, vector_store_id, selected, plan, len(plans) + 1, len(plans) + 1, class_name, school, not merger.exam_name, merger.add, is_duplicate)
+
+        data = {
+            "exam_name": merger.exam_name or f"{class_name} Practice Exam",
+            "questions": merger.questions,
+        }
+        print(data)
+        return data
+
+    # Generates the whole exam with one structured output call on materials
+    # from direct_materials. Returns the same data as run_agent, without the
+    # questions is_duplicate rejects.
+    def run_direct(self, materials, class_name, school, topics, on_event=None, is_duplicate=None):
+        content = DIRECT_PROMPT.format(
+            class_name=class_name,
+            school=school,
+            topics=topics if topics != "" else "ANY",
+            materials=materials or "None provided, use what is usually taught in this class.",
+        )
+        response = llm_gateway.call(
+            model,
+            self.client.beta.chat.completions.parse,
+            messages=[
+                {"role": "system", "content": prompt_instructions},
+                {"role": "user", "content": content},
+            ],
+            model=model,
+            temperature=1.1,
+            response_format=ExamResponseFormat
+        )
+        parsed = response.choices[0].message.parsed
+
+        data = {
+            "exam_name": parsed.exam_name,
+            "questions": []
+        }
+        if on_event:
+            on_event("exam_name", parsed.exam_name)
+        for args in parsed.questions:
+            question = build_question(args.model_dump())
+            if question is None or (question["type"] == "mc" and not question["answer_choices"]):
+                continue
+            if is_duplicate and is_duplicate(question):
+                continue
+            data["questions"].append(question)
+            if on_event:
+                on_event("question", question)
+        metrics.incr("exam_maker.direct_runs")
+        print(data)
+        return data
+
+    # on_event(kind, value) is called with ("exam_name", name) and
+    # ("question", question) as soon as the assistant creates them. Questions
+    # is_duplicate(question) rejects are sent back to the assistant to replace.
+    def run_agent(self, threadId, on_event=None, is_duplicate=None):
         data = {
             "exam_name": "",
             "questions": []
         }
 
-        # create run for assistant
-        run = self.client.beta.threads.runs.create(
-            thread_id=threadId,
-            assistant_id=self.agent.id
-        )
+        def handle_tool_calls(toolCalls):
+            toolOutputs = []
+            print(toolCalls)
 
-        # retrieve status of run
-        while run.status in ["queued", "in_progress", "requires_action"]:
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=threadId,
-                run_id=run.id
-            )
-            if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
-                toolCalls = run.required_action.submit_tool_outputs.tool_calls
-                toolOutputs = []
-                print(toolCalls)
-
-                for toolCall in toolCalls:
-                    try:
-                        if toolCall.function.name == "createQuestion":
-                            if toolCall.function.arguments:
-                                args = json.loads(toolCall.function.arguments)
-                                print(args)
-                                if args["type"] == "mc":
-                                    data["questions"].append({
-                                        "question": args["question"],
-                                        "type": args["type"],
-                                        "answer_choices": args["answer_choices"],
-                                        "correct_answer": args["correct_answer"],
-                                        "explanation": args["answer_explanation"]
-                                    })
-                                elif args["type"] == "oe":
-                                    data["questions"].append({
-                                        "question": args["question"],
-                                        "type": args["type"],
-                                        "correct_answer": args["correct_answer"],
-                                        "explanation": args["answer_explanation"]
-                                    })
-
-                                # Do something with args
+            for toolCall in toolCalls:
+                try:
+                    if toolCall.function.name == "createQuestion":
+                        if toolCall.function.arguments:
+                            args = json.loads(toolCall.function.arguments)
+                            print(args)
+                            question = build_question(args)
+                            if question is not None and is_duplicate and is_duplicate(question):
                                 toolOutputs.append({
                                     "tool_call_id": toolCall.id,
-                                    "output": "success"
+                                    "output": "rejected, this question duplicates one the student already has, create a different question"
                                 })
-                            else:
-                                toolOutputs.append({
-                                    "tool_call_id": toolCall.id,
-                                    "output": "no arguments provided"
-                                })
-                        elif toolCall.function.name == "createExamName":
-                            if toolCall.function.arguments:
-                                args = json.loads(toolCall.function.arguments)
-                                data["exam_name"] = args["exam_name"]
-                                toolOutputs.append({
-                                    "tool_call_id": toolCall.id,
-                                    "output": "success"
-                                })
-                            else:
-                                toolOutputs.append({
-                                    "tool_call_id": toolCall.id,
-                                    "output": "no arguments provided"
-                                })
-                    except Exception as e:
-                        toolOutputs.append({
-                            "tool_call_id": toolCall.id,
-                            "output": str(e)
-                        })
-
-                run = self.client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=threadId,
-                    run_id=run.id,
-                    tool_outputs=toolOutputs
-                )
-
-        messages = self.client.beta.threads.messages.list(
+                                continue
+                            if question is not None:
+                                data["questions"].append(question)
+                                if on_event:
+                                    on_event("question", question)
+
+                            # Do something with args
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "success"
+                            })
+                        else:
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "no arguments provided"
+                            })
+                    elif toolCall.function.name == "createExamName":
+                        if toolCall.function.arguments:
+                            args = json.loads(toolCall.function.arguments)
+                            data["exam_name"] = args["exam_name"]
+                            if on_event:
+                                on_event("exam_name", args["exam_name"])
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "success"
+                            })
+                        else:
+                            toolOutputs.append({
+                                "tool_call_id": toolCall.id,
+                                "output": "no arguments provided"
+                            })
+                except Exception as e:
+                    toolOutputs.append({
+                        "tool_call_id": toolCall.id,
+                        "output": str(e)
+                    })
+            return toolOutputs
+
+        def run(assistant_id):
+            self.assistant_id = assistant_id
+            execute_run(self.client, threadId, assistant_id, handle_tool_calls, "exam_maker", model)
+
+        # run the assistant, answering its tool calls until it finishes
+        assistant_registry.call_with_assistant(self.client, self.assistant_id, run)
+
+        messages = llm_gateway.call(
+            "assistants",
+            self.client.beta.threads.messages.list,
             thread_id=threadId,
             order="asc"
         )
@@ -183,13 +501,12 @@ class Agent:
         return data
 
     def delete_thread(self, threadId):
-        self.client.beta.threads.delete(threadId) 
+        try:
+            llm_gateway.call("assistants", self.client.beta.threads.delete, threadId)
+        finally:
+            self.vector_stores.release(self.thread_stores.pop(threadId, None))
 
+    # Materials uploaded before are reused by content hash, the rest are
+    # uploaded in parallel
     def add_files(self, files):
-        file_ids = []
-        for file in files:
-            # print(filename)
-            # print(file_obj)
-            file_response = self.client.files.create(file=file, purpose="assistants")
-            file_ids.append(file_response.id)
-        return file_ids
\ No newline at end of file
+        return file_cache.upload_files(self.client, files)
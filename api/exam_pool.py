@@ -0,0 +1,145 @@
+import asyncio
+import os
+import re
+import time
+import uuid
+from collections import defaultdict, deque
+import metrics
+
+# Ready-made exams for popular class/school/topics combinations. Requests are
+# counted per key and keys asked for often enough get a small pool of exams
+# generated in the background, so a request without uploaded files can be
+# served at once. Pre-generation is capped at EXAM_POOL_DAILY_BUDGET exams a
+# day, entries expire after EXAM_POOL_TTL and every exam carries a pool_id so
+# a user is never served one that is already in their exams.
+
+EXAM_POOL_DAILY_BUDGET = int(os.getenv("EXAM_POOL_DAILY_BUDGET", "20"))
+EXAM_POOL_SIZE = int(os.getenv("EXAM_POOL_SIZE", "2"))
+EXAM_POOL_TTL = int(os.getenv("EXAM_POOL_TTL", str(24 * 3600)))
+# A key is popular once it was requested this many times within the window
+EXAM_POOL_MIN_REQUESTS = int(os.getenv("EXAM_POOL_MIN_REQUESTS", "3"))
+EXAM_POOL_WINDOW = int(os.getenv("EXAM_POOL_WINDOW", str(24 * 3600)))
+EXAM_POOL_MAX_KEYS = int(os.getenv("EXAM_POOL_MAX_KEYS", "20"))
+# Different users an exam is served to before it is replaced
+EXAM_POOL_MAX_SERVES = int(os.getenv("EXAM_POOL_MAX_SERVES", "5"))
+EXAM_POOL_REFILL_INTERVAL = int(os.getenv("EXAM_POOL_REFILL_INTERVAL", "60"))
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", (text or "").lower()).split())
+
+
+def pool_key(class_name, school, topics):
+    topic_list = sorted({normalize(topic) for topic in re.split(r"[,;\n]", topics or "") if normalize(topic)})
+    return (normalize(class_name), normalize(school), ", ".join(topic_list))
+
+
+class ExamPool:
+    # generate(class_name, school, topics) is a coroutine returning exam data
+    # like Agent.run_agent
+    def __init__(self, generate, daily_budget=EXAM_POOL_DAILY_BUDGET, size=EXAM_POOL_SIZE):
+        self.generate = generate
+        self.daily_budget = daily_budget
+        self.size = size
+        self.requests = defaultdict(deque)
+        # Original spelling of each key, used when generating for it
+        self.requested_as = {}
+        self.entries = defaultdict(list)
+        self.generated = deque()
+        self.wake = None
+        self.task = None
+
+    async def start(self):
+        if self.task is not None or self.daily_budget <= 0:
+            return
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self.refill())
+
+    def record(self, key, class_name, school, topics):
+        now = time.time()
+        requests = self.requests[key]
+        requests.append(now)
+        while requests and now - requests[0] > EXAM_POOL_WINDOW:
+            requests.popleft()
+        self.requested_as[key] = (class_name, school, topics)
+        if self.wake and len(self.entries[key]) < self.size and len(requests) >= EXAM_POOL_MIN_REQUESTS:
+            self.wake.set()
+
+    # Returns exam data for a request without uploaded files, or None when the
+    # pool has nothing this user hasn't seen
+    def claim(self, user_id, past_exams, class_name, school, topics):
+        key = pool_key(class_name, school, topics)
+        self.record(key, class_name, school, topics)
+        seen = {exam.get("pool_id") for exam in past_exams or [] if exam.get("pool_id")}
+        now = time.time()
+        for entry in self.entries[key]:
+            if now - entry["created_at"] > EXAM_POOL_TTL:
+                continue
+            if entry["pool_id"] in seen or user_id in entry["served_to"]:
+                continue
+            entry["served_to"].add(user_id)
+            if len(entry["served_to"]) >= EXAM_POOL_MAX_SERVES:
+                self.entries[key].remove(entry)
+                if self.wake:
+                    self.wake.set()
+            metrics.incr("exam_pool.hits")
+            return {**entry["data"], "pool_id": entry["pool_id"]}
+        metrics.incr("exam_pool.misses")
+        return None
+
+    def expire(self):
+        now = time.time()
+        for key in list(self.entries):
+            self.entries[key] = [entry for entry in self.entries[key] if now - entry["created_at"] <= EXAM_POOL_TTL]
+            if not self.entries[key]:
+                del self.entries[key]
+        for key in list(self.requests):
+            requests = self.requests[key]
+            while requests and now - requests[0] > EXAM_POOL_WINDOW:
+                requests.popleft()
+            if not requests:
+                del self.requests[key]
+                self.requested_as.pop(key, None)
+        while self.generated and now - self.generated[0] > 24 * 3600:
+            self.generated.popleft()
+
+    # Most requested keys first, only those with room in their pool
+    def keys_to_fill(self):
+        popular = [key for key, requests in self.requests.items() if len(requests) >= EXAM_POOL_MIN_REQUESTS]
+        popular.sort(key=lambda key: len(self.requests[key]), reverse=True)
+        return [key for key in popular[:EXAM_POOL_MAX_KEYS] if len(self.entries.get(key, [])) < self.size]
+
+    async def refill(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=EXAM_POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            self.expire()
+            for key in self.keys_to_fill():
+                if len(self.generated) >= self.daily_budget:
+                    metrics.incr("exam_pool.over_budget")
+                    break
+                class_name, school, topics = self.requested_as[key]
+                self.generated.append(time.time())
+                start = time.time()
+                try:
+                    data = await self.generate(class_name, school, topics)
+                except Exception as e:
+                    print(f"Failed to pre-generate exam for {key}: {e}")
+                    metrics.incr("exam_pool.failures")
+                    continue
+                self.entries[key].append({
+                    "pool_id": uuid.uuid4().hex,
+                    "data": data,
+                    "created_at": time.time(),
+                    "served_to": set(),
+                })
+                metrics.incr("exam_pool.generated")
+                metrics.observe("exam_pool.generation", time.time() - start)
+            metrics.gauge("exam_pool.entries", sum(len(entries) for entries in self.entries.values()))
+            metrics.gauge("exam_pool.generated_today", len(self.generated))
+            # Pools are filled one exam per key per pass, go again if needed
+            if self.keys_to_fill() and len(self.generated) < self.daily_budget:
+                self.wake.set()
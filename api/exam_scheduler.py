@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import time
+from collections import defaultdict
+import metrics
+
+# Admission control for exam generation. At most EXAM_MAX_CONCURRENT
+# generations run per process and at most EXAM_MAX_PER_USER per user. Others
+# wait in a queue ordered by tier, then arrival. When the queue is full or the
+# expected wait is too long the request is shed with a retry-after instead.
+
+EXAM_MAX_CONCURRENT = int(os.getenv("EXAM_MAX_CONCURRENT", "4"))
+EXAM_MAX_PER_USER = int(os.getenv("EXAM_MAX_PER_USER", "1"))
+EXAM_MAX_QUEUED = int(os.getenv("EXAM_MAX_QUEUED", "20"))
+EXAM_MAX_QUEUE_WAIT = float(os.getenv("EXAM_MAX_QUEUE_WAIT", "120"))
+
+# Lower runs first, unknown tiers are treated like free. Pre-generated pool
+# exams only run when no user is waiting.
+TIER_PRIORITY = {
+    "diamond": 0,
+    "gold": 1,
+    "free": 2,
+    "pool": 3,
+}
+
+
+class SchedulerFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Exam generation is at capacity, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class ExamScheduler:
+    def __init__(self, max_concurrent=EXAM_MAX_CONCURRENT, max_per_user=EXAM_MAX_PER_USER, max_queued=EXAM_MAX_QUEUED, max_queue_wait=EXAM_MAX_QUEUE_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.running = 0
+        self.running_per_user = defaultdict(int)
+        self.waiting = []
+        self.sequence = itertools.count()
+        # Moving average of generation time, used to estimate queue waits
+        self.average_duration = 60.0
+
+    def can_start(self, user_id):
+        return self.running < self.max_concurrent and self.running_per_user.get(user_id, 0) < self.max_per_user
+
+    def estimated_wait(self, position):
+        return int((position // self.max_concurrent + 1) * self.average_duration)
+
+    def start(self, user_id):
+        self.running += 1
+        self.running_per_user[user_id] += 1
+        self.report()
+
+    def report(self):
+        metrics.gauge("exam_scheduler.running", self.running)
+        metrics.gauge("exam_scheduler.queue_depth", len(self.waiting))
+
+    # Starts the highest priority waiters that are allowed to run
+    def dispatch(self):
+        for waiter in sorted(self.waiting):
+            _, _, user_id, future = waiter
+            if self.running >= self.max_concurrent:
+                break
+            if future.done() or not self.can_start(user_id):
+                continue
+            self.waiting.remove(waiter)
+            self.start(user_id)
+            future.set_result(None)
+        self.report()
+
+    async def acquire(self, user_id, tier, can_shed=True):
+        priority = TIER_PRIORITY.get(tier, TIER_PRIORITY["free"])
+        start = time.time()
+        future = asyncio.get_running_loop().create_future()
+        waiter = (priority, next(self.sequence), user_id, future)
+        self.waiting.append(waiter)
+        self.dispatch()
+        if future.done():
+            metrics.observe("exam_scheduler.wait", 0.0)
+            return
+
+        if can_shed:
+            ahead = sorted(self.waiting).index(waiter)
+            retry_after = self.estimated_wait(ahead)
+            if len(self.waiting) > self.max_queued or retry_after > self.max_queue_wait:
+                self.waiting.remove(waiter)
+                self.report()
+                metrics.incr(f"exam_scheduler.shed.{tier}")
+                raise SchedulerFullError(retry_after)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+                self.report()
+            elif future.done() and not future.cancelled():
+                # Started just as it was cancelled, give the slot back
+                self.release(user_id)
+            raise
+        metrics.observe("exam_scheduler.wait", time.time() - start)
+        metrics.observe(f"exam_scheduler.wait.{tier}", time.time() - start)
+
+    def release(self, user_id, duration=None):
+        self.running -= 1
+        self.running_per_user[user_id] -= 1
+        if self.running_per_user[user_id] <= 0:
+            del self.running_per_user[user_id]
+        if duration is not None:
+            self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+        self.dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, tier, can_shed=True):
+        await self.acquire(user_id, tier, can_shed)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.time() - start)
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+import llm_gateway
+
+# Maps the SHA-256 of uploaded materials to their OpenAI file id so the same
+# lecture pdf is uploaded once rather than on every request. Entries expire
+# after FILE_CACHE_TTL, the least recently used are evicted past
+# FILE_CACHE_MAX_ENTRIES, and a hit is checked against the remote file when
+# it wasn't checked for FILE_CACHE_VALIDATE_INTERVAL. Misses are uploaded in
+# parallel, and concurrent requests uploading the same bytes share one upload.
+
+FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", str(7 * 24 * 3600)))
+FILE_CACHE_MAX_ENTRIES = int(os.getenv("FILE_CACHE_MAX_ENTRIES", "1000"))
+FILE_CACHE_VALIDATE_INTERVAL = int(os.getenv("FILE_CACHE_VALIDATE_INTERVAL", "600"))
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", "4"))
+
+upload_pool = ThreadPoolExecutor(max_workers=FILE_UPLOAD_CONCURRENCY, thread_name_prefix="upload")
+
+
+def read_content(content):
+    if hasattr(content, "read"):
+        content.seek(0)
+        return content.read()
+    return content
+
+
+class FileCache:
+    def __init__(self, max_entries=FILE_CACHE_MAX_ENTRIES, ttl=FILE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get(self, client, digest):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            if now - entry["created_at"] > self.ttl:
+                del self.entries[digest]
+                return None
+            self.entries.move_to_end(digest)
+            if now - entry["checked_at"] <= FILE_CACHE_VALIDATE_INTERVAL:
+                return entry["file_id"]
+        try:
+            llm_gateway.call("assistants", client.files.retrieve, entry["file_id"])
+        except Exception as e:
+            print(f"Cached file {entry['file_id']} is gone, uploading again: {e}")
+            metrics.incr("file_cache.stale")
+            with self.lock:
+                self.entries.pop(digest, None)
+            return None
+        with self.lock:
+            entry["checked_at"] = time.time()
+        return entry["file_id"]
+
+    def put(self, digest, file_id):
+        now = time.time()
+        with self.lock:
+            self.entries[digest] = {"file_id": file_id, "created_at": now, "checked_at": now}
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def upload(self, client, filename, content, digest):
+        try:
+            file_id = self.get(client, digest)
+            if file_id is not None:
+                metrics.incr("file_cache.hits")
+                return file_id
+            metrics.incr("file_cache.misses")
+            start = time.time()
+            response = llm_gateway.call("assistants", client.files.create, idempotent=False, file=(filename, content), purpose="assistants")
+            metrics.observe("file_cache.upload", time.time() - start)
+            self.put(digest, response.id)
+            return response.id
+        finally:
+            with self.lock:
+                self.in_flight.pop(digest, None)
+
+    # files are (filename, bytes or file object) pairs, returns their file ids
+    # in the same order
+    def upload_files(self, client, files):
+        futures = []
+        for filename, content in files:
+            content = read_content(content)
+            digest = hashlib.sha256(content).hexdigest()
+            with self.lock:
+                future = self.in_flight.get(digest)
+                if future is None:
+                    future = Future()
+                    self.in_flight[digest] = future
+                    owner = True
+                else:
+                    owner = False
+            if owner:
+                upload_future = upload_pool.submit(self.upload, client, filename, content, digest)
+                upload_future.add_done_callback(lambda done, future=future: copy_result(done, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+
+def copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+file_cache = FileCache()
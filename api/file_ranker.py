@@ -0,0 +1,89 @@
+import os
+import re
+from lexical_ranker import BM25, tokenize
+from text_extraction import iter_text
+
+# Decides which downloaded files are relevant to the course without a model
+# call. Each file is described by its filename, the title and snippet of the
+# search result it came from and the start of its text. A file is kept when
+# enough of the weighted course terms (topics count double) appear in that
+# description and kept files are ordered by BM25 against the course and the
+# search queries. Files just under the cutoff are borderline and can be sent
+# to the LLM filter when FILE_RANK_LLM_RERANK is set.
+
+FILE_RANK_MIN_COVERAGE = float(os.getenv("FILE_RANK_MIN_COVERAGE", "0.3"))
+FILE_RANK_BORDERLINE_COVERAGE = float(os.getenv("FILE_RANK_BORDERLINE_COVERAGE", "0.15"))
+FILE_RANK_LLM_RERANK = os.getenv("FILE_RANK_LLM_RERANK", "0") == "1"
+# Files with these words in their name or title are never kept
+FILE_RANK_EXCLUDE_TERMS = set(os.getenv("FILE_RANK_EXCLUDE_TERMS", "syllabus,schedule,calendar").split(","))
+FIRST_PAGE_WORDS = int(os.getenv("FILE_RANK_FIRST_PAGE_WORDS", "400"))
+
+
+def clean(text):
+    # Bing highlights matches with tags, filenames separate words with _ - .
+    return re.sub(r"<[^>]+>|[_\-.]", " ", text or "")
+
+
+def first_page(filename, content):
+    words = []
+    for piece in iter_text(filename, content):
+        words.extend(piece.split())
+        if len(words) >= FIRST_PAGE_WORDS:
+            break
+    return " ".join(words[:FIRST_PAGE_WORDS])
+
+
+# candidate is {"filename", "content", "title", "snippet"}, "first_page" can
+# be given instead of "content" and is stored on the candidate once extracted
+def describe(candidate):
+    text = candidate.get("first_page")
+    if text is None:
+        text = candidate["first_page"] = first_page(candidate["filename"], candidate.get("content") or b"")
+    return " ".join([clean(candidate["filename"]), clean(candidate.get("title")), clean(candidate.get("snippet")), text])
+
+
+def term_weights(class_name, topics):
+    weights = {term: 1.0 for term in tokenize(class_name or "")}
+    weights.update({term: 2.0 for term in tokenize(topics or "")})
+    return weights
+
+
+def coverage(tokens, weights):
+    if not weights:
+        return 1.0
+    return sum(weight for term, weight in weights.items() if term in tokens) / sum(weights.values())
+
+
+def is_excluded(candidate):
+    words = set(tokenize(clean(candidate["filename"]) + " " + clean(candidate.get("title"))))
+    return bool(words & FILE_RANK_EXCLUDE_TERMS)
+
+
+# Whether a single candidate passes the cutoff, used to stop downloading once
+# enough relevant files arrived
+def is_relevant(candidate, class_name, topics):
+    if is_excluded(candidate):
+        return False
+    return coverage(set(tokenize(describe(candidate))), term_weights(class_name, topics)) >= FILE_RANK_MIN_COVERAGE
+
+
+# Returns each candidate's (coverage, bm25 score)
+def score_files(candidates, class_name, topics, search_queries):
+    weights = term_weights(class_name, topics)
+    scorer = BM25(" ".join([class_name or "", topics or ""] + list(search_queries)))
+    coverages = []
+    for candidate in candidates:
+        text = describe(candidate)
+        scorer.add(text)
+        coverages.append(0.0 if is_excluded(candidate) else coverage(set(tokenize(text)), weights))
+    return list(zip(coverages, scorer.scores()))
+
+
+# Returns the indices of relevant candidates, most relevant first, and the
+# indices of borderline ones
+def rank_files(candidates, class_name, topics, search_queries):
+    scores = score_files(candidates, class_name, topics, search_queries)
+    order = sorted(range(len(candidates)), key=lambda i: (-scores[i][1], -scores[i][0]))
+    keep = [i for i in order if scores[i][0] >= FILE_RANK_MIN_COVERAGE]
+    borderline = [i for i in order if FILE_RANK_BORDERLINE_COVERAGE <= scores[i][0] < FILE_RANK_MIN_COVERAGE]
+    return keep, borderline
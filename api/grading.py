@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+from AnswerChecker import checkOpenEndedAnswerWithModel, gradeOpenEndedAnswers, preGradeOpenEndedAnswer
+from verdict_cache import VerdictCache
+from offload import run_blocking
+import similarity_scorer
+import metrics
+
+# Maximum number of open-ended answers graded at the same time for one submission
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "8"))
+
+# "single" grades each open-ended answer with its own request, "batch" grades
+# all open-ended answers of a submission in one request
+GRADING_MODE = os.getenv("GRADING_MODE", "single")
+
+# Accept or reject open-ended answers by local similarity before the model,
+# off until calibrate_similarity.py has produced thresholds for real answers
+GRADING_SIMILARITY_ENABLED = os.getenv("GRADING_SIMILARITY_ENABLED", "0") == "1"
+
+verdict_cache = VerdictCache()
+
+# Model gradings currently running, keyed like the verdict cache, so an answer
+# graded in the background by /grade_answer is awaited instead of regraded
+in_flight = {}
+
+
+def question_fingerprint(question):
+    content = json.dumps(
+        [question.get("question", ""), question["type"], question["correct_answer"], question.get("explanation", "")]
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# Only case and whitespace are ignored, any other difference in the answer
+# could change its verdict
+def verdict_key(question, answer):
+    normalized = hashlib.sha256(" ".join(answer.lower().split()).encode("utf-8")).hexdigest()
+    return f"{question_fingerprint(question)}:{normalized}"
+
+
+async def get_cached_verdict(key):
+    if verdict_cache.persistent:
+        value = await run_blocking(verdict_cache.get, key)
+    else:
+        value = verdict_cache.get(key)
+    return None if value is None else value["correct"]
+
+
+async def cache_verdict(key, is_correct):
+    value = {"correct": is_correct}
+    if verdict_cache.persistent:
+        await run_blocking(verdict_cache.put, key, value)
+    else:
+        verdict_cache.put(key, value)
+
+
+# Grades what can be graded without the model: multiple choice, the local
+# pre-grader and the verdict cache. Returns None when the model is needed.
+async def grade_locally(question, answer):
+    if question["type"] == "mc":
+        return answer == question["correct_answer"]
+    elif question["type"] == "oe":
+        is_correct = preGradeOpenEndedAnswer(answer, question["correct_answer"], question.get("rubric"))
+        if is_correct is None:
+            is_correct = await get_cached_verdict(verdict_key(question, answer))
+        return is_correct
+    return False
+
+
+# Scores the remaining open-ended answers in one pass and settles the ones
+# that are clearly right or wrong. Returns the indices still undecided.
+def prescore_by_similarity(questions, answers, pending, verdicts):
+    if not GRADING_SIMILARITY_ENABLED or len(pending) == 0:
+        return pending
+    scores = similarity_scorer.score_pairs(
+        [answers[str(i)] for i in pending],
+        [questions[i]["correct_answer"] for i in pending],
+    )
+    undecided = []
+    for i, verdict in zip(pending, similarity_scorer.classify(scores)):
+        if verdict is None:
+            undecided.append(i)
+        else:
+            metrics.incr("grading.similarity.accepted" if verdict else "grading.similarity.rejected")
+            verdicts[i] = verdict
+    metrics.incr("grading.similarity.undecided", len(undecided))
+    return undecided
+
+
+async def run_model_grading(question, answer, key):
+    is_correct = await checkOpenEndedAnswerWithModel(
+        answer,
+        question["correct_answer"],
+        question["explanation"],
+        question.get("rubric"),
+    )
+    await cache_verdict(key, is_correct)
+    return is_correct
+
+
+async def grade_with_model(question, answer):
+    key = verdict_key(question, answer)
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_model_grading(question, answer, key))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    # Shielded so a cancelled request doesn't cancel a grading others await
+    return await asyncio.shield(task)
+
+
+async def grade_answer(question, answer):
+    is_correct = await grade_locally(question, answer)
+    if is_correct is None:
+        verdicts = [None]
+        if prescore_by_similarity([question], {"0": answer}, [0], verdicts):
+            return await grade_with_model(question, answer)
+        is_correct = verdicts[0]
+    return is_correct
+
+
+async def grade_pending_concurrently(questions, answers, pending, verdicts, concurrency=GRADING_CONCURRENCY):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def grade(i):
+        async with semaphore:
+            verdicts[i] = await grade_with_model(questions[i], answers[str(i)])
+
+    await asyncio.gather(*[grade(i) for i in pending])
+
+
+async def grade_pending_batched(questions, answers, pending, verdicts, concurrency=GRADING_CONCURRENCY):
+    running = [i for i in pending if verdict_key(questions[i], answers[str(i)]) in in_flight]
+    if len(running) > 0:
+        await grade_pending_concurrently(questions, answers, running, verdicts, concurrency)
+        pending = [i for i in pending if i not in running]
+        if len(pending) == 0:
+            return
+
+    items = [
+        (answers[str(i)], questions[i]["correct_answer"], questions[i]["explanation"], questions[i].get("rubric"))
+        for i in pending
+    ]
+    try:
+        results = await gradeOpenEndedAnswers(items)
+    except Exception as e:
+        # Malformed or failed batch response, grade each answer on its own instead
+        print(f"Batch grading failed, falling back to single grading: {e}")
+        return await grade_pending_concurrently(questions, answers, pending, verdicts, concurrency)
+
+    for i, (is_correct, _) in zip(pending, results):
+        verdicts[i] = is_correct
+        await cache_verdict(verdict_key(questions[i], answers[str(i)]), is_correct)
+
+
+# Yields (index, is_correct) for every question as soon as its verdict is
+# known: local verdicts first, then model verdicts in completion order
+async def iter_grades(questions, answers, mode=GRADING_MODE, concurrency=GRADING_CONCURRENCY):
+    verdicts = [None] * len(questions)
+    pending = []
+    for i, question in enumerate(questions):
+        verdicts[i] = await grade_locally(question, answers[str(i)])
+        if verdicts[i] is None:
+            pending.append(i)
+        else:
+            yield i, verdicts[i]
+
+    undecided = prescore_by_similarity(questions, answers, pending, verdicts)
+    for i in pending:
+        if verdicts[i] is not None:
+            yield i, verdicts[i]
+    if len(undecided) == 0:
+        return
+
+    if mode == "batch":
+        await grade_pending_batched(questions, answers, undecided, verdicts, concurrency)
+        for i in undecided:
+            yield i, verdicts[i]
+    else:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def grade(i):
+            async with semaphore:
+                return i, await grade_with_model(questions[i], answers[str(i)])
+
+        for graded in asyncio.as_completed([grade(i) for i in undecided]):
+            yield await graded
+
+
+async def grade_answers(questions, answers, mode=GRADING_MODE, concurrency=GRADING_CONCURRENCY):
+    verdicts = [None] * len(questions)
+    async for i, is_correct in iter_grades(questions, answers, mode, concurrency):
+        verdicts[i] = is_correct
+    return verdicts
+
+
+# Grades one answer ahead of submission so /grade_quiz finds the verdict
+# cached or in flight
+async def grade_answer_in_background(question, answer):
+    try:
+        await grade_answer(question, answer)
+    except Exception as e:
+        print(f"Background grading failed: {e}")
@@ -0,0 +1,64 @@
+import math
+import re
+from collections import Counter
+
+# BM25 scoring of documents against a fixed query, without a model call.
+# Documents are added one at a time and only their length and the counts of
+# query terms are kept, so large corpora can be streamed through it.
+
+STOPWORDS = set("""
+a an and are as at be by for from has have in is it its of on or that the to
+was were will with this these those what which who how why when where into
+about than then there their them they we you your our not no can do does
+""".split())
+
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS and len(word) > 1]
+
+
+class BM25:
+    def __init__(self, query, k1=1.5, b=0.75):
+        self.terms = set(tokenize(query))
+        self.k1 = k1
+        self.b = b
+        self.lengths = []
+        self.total_length = 0
+        self.counts = []
+        self.document_frequency = Counter()
+
+    # Returns the document's index
+    def add(self, text):
+        tokens = tokenize(text)
+        counts = Counter(token for token in tokens if token in self.terms)
+        self.lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.counts.append(counts)
+        self.document_frequency.update(counts.keys())
+        return len(self.lengths) - 1
+
+    def scores(self):
+        if not self.lengths:
+            return []
+        statistics = self.statistics()
+        return [self.score(index, statistics) for index in range(len(self.lengths))]
+
+    # Corpus statistics of the documents added so far
+    def statistics(self):
+        count = len(self.lengths)
+        average_length = self.total_length / count or 1
+        idf = {
+            term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in self.document_frequency.items()
+        }
+        return average_length, idf
+
+    # Scores one document against the documents added so far, streaming
+    # callers can rank documents before the corpus is complete
+    def score(self, index, statistics=None):
+        average_length, idf = statistics or self.statistics()
+        length = self.lengths[index]
+        score = 0.0
+        for term, tf in self.counts[index].items():
+            score += idf[term] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / average_length))
+        return score
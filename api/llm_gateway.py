@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import openai
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+import metrics
+
+# Every OpenAI call in the api goes through this module. It holds the shared
+# clients, keeps each model within its requests-per-minute and
+# tokens-per-minute budget with token buckets, and retries rate limited and
+# failed calls with jittered exponential backoff. Calls that create something
+# (threads, runs, files, tool outputs) pass idempotent=False and are only
+# retried when rate limited, since other failures may have gone through.
+
+load_dotenv()
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+# Tokens reserved for a call when the caller doesn't estimate its size
+LLM_DEFAULT_TOKEN_ESTIMATE = int(os.getenv("LLM_DEFAULT_TOKEN_ESTIMATE", "1000"))
+
+# [requests per minute, tokens per minute] per model for this process, None
+# means unlimited. "assistants" covers Assistants API calls that don't run the
+# model (threads, files, run polling). Override with LLM_RATE_LIMITS as JSON.
+LLM_RATE_LIMITS = {
+    "gpt-4o": [500, 30000],
+    "gpt-4o-mini": [500, 200000],
+    "assistants": [1000, None],
+}
+LLM_RATE_LIMITS.update(json.loads(os.getenv("LLM_RATE_LIMITS", "{}")))
+
+# The gateway retries, so the SDK's own retries are turned off
+client = OpenAI(max_retries=0)
+async_client = AsyncOpenAI(max_retries=0)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes amount from the bucket, going negative if needed, and returns how
+    # long the caller has to wait for its share to be refilled
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    # Corrects a reservation once the real amount is known
+    def adjust(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, estimated_tokens):
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        return wait
+
+    def settle(self, estimated_tokens, used_tokens):
+        if self.tokens and used_tokens is not None:
+            self.tokens.adjust(estimated_tokens - used_tokens)
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def limiter_for(model):
+    with limiters_lock:
+        if model not in limiters:
+            requests_per_minute, tokens_per_minute = LLM_RATE_LIMITS.get(model, [None, None])
+            limiters[model] = ModelLimiter(requests_per_minute, tokens_per_minute)
+        return limiters[model]
+
+
+def estimate_tokens(kwargs):
+    text = json.dumps(kwargs.get("messages", ""), default=str)
+    return len(text) // 4 + (kwargs.get("max_tokens") or LLM_DEFAULT_TOKEN_ESTIMATE)
+
+
+def used_tokens(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def is_retryable(error, idempotent=True):
+    if isinstance(error, openai.RateLimitError):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(attempt, error):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(LLM_RETRY_MAX_DELAY, float(retry_after))
+    except ValueError:
+        pass
+    # Full jitter so callers throttled together don't retry together
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def record_error(model, attempt, error, idempotent=True):
+    status = getattr(error, "status_code", None) or type(error).__name__
+    if is_retryable(error, idempotent) and attempt < LLM_MAX_RETRIES:
+        metrics.incr(f"llm.{model}.retries")
+        metrics.incr(f"llm.{model}.retries.{status}")
+        return True
+    metrics.incr(f"llm.{model}.errors")
+    return False
+
+
+def throttle_wait(model, estimated_tokens):
+    wait = limiter_for(model).reserve(estimated_tokens)
+    metrics.incr(f"llm.{model}.requests")
+    if wait > 0:
+        metrics.incr(f"llm.{model}.throttled")
+        metrics.observe(f"llm.{model}.throttle_wait", wait)
+    return wait
+
+
+# Waits for budget without making the call, for streaming APIs whose errors
+# surface later while iterating
+def reserve(model, estimated_tokens=LLM_DEFAULT_TOKEN_ESTIMATE):
+    time.sleep(throttle_wait(model, estimated_tokens))
+
+
+# Corrects the model's token budget once the tokens used by work reserved
+# earlier are known, e.g. an assistant run when it finishes
+def settle(model, estimated_tokens, response):
+    limiter_for(model).settle(estimated_tokens, used_tokens(response))
+
+
+# call("gpt-4o", client.chat.completions.create, model="gpt-4o", messages=...)
+def call(model, fn, *args, estimated_tokens=None, idempotent=True, **kwargs):
+    estimated_tokens = estimated_tokens or estimate_tokens(kwargs)
+    attempt = 0
+    while True:
+        time.sleep(throttle_wait(model, estimated_tokens))
+        try:
+            response = fn(*args, **kwargs)
+        except Exception as e:
+            if not record_error(model, attempt, e, idempotent):
+                raise
+            time.sleep(retry_delay(attempt, e))
+            attempt += 1
+            continue
+        limiter_for(model).settle(estimated_tokens, used_tokens(response))
+        return response
+
+
+# Same as call for coroutine functions of async_client
+async def acall(model, fn, *args, estimated_tokens=None, idempotent=True, **kwargs):
+    estimated_tokens = estimated_tokens or estimate_tokens(kwargs)
+    attempt = 0
+    while True:
+        await asyncio.sleep(throttle_wait(model, estimated_tokens))
+        try:
+            response = await fn(*args, **kwargs)
+        except Exception as e:
+            if not record_error(model, attempt, e, idempotent):
+                raise
+            await asyncio.sleep(retry_delay(attempt, e))
+            attempt += 1
+            continue
+        limiter_for(model).settle(estimated_tokens, used_tokens(response))
+        return response
@@ -0,0 +1,80 @@
+# Checks that slow requests don't block the event loop for everyone else.
+#
+# Usage: python load_test.py --url http://localhost:8000 --user a@example.com b@example.com c@example.com d@example.com
+#
+# Starts --concurrency exam generations at once, spread over the --user
+# accounts in turn, and while they run repeatedly times a cheap request
+# (GET /metrics). If the server blocks its event loop during generation the
+# probe latency grows to the length of a whole generation, otherwise it stays
+# in the milliseconds and the generations finish in about the time of the
+# slowest one rather than the sum. The scheduler runs only EXAM_MAX_PER_USER
+# (default 1) generations per user at a time, so give at least --concurrency
+# users or start the server with EXAM_MAX_PER_USER raised. Every generation
+# uses one exam credit of its user.
+
+import argparse
+import asyncio
+import time
+import aiohttp
+
+
+async def create_exam(session, url, user, topics):
+    data = aiohttp.FormData()
+    data.add_field("class_name", "Introduction to Psychology")
+    data.add_field("school", "Stanford University")
+    data.add_field("topics", topics)
+    start = time.time()
+    async with session.post(f"{url}/create_exam/{user}", data=data) as response:
+        await response.read()
+        return response.status, time.time() - start
+
+
+async def probe(session, url, stop, latencies):
+    while not stop.is_set():
+        start = time.time()
+        async with session.get(f"{url}/metrics") as response:
+            await response.read()
+        latencies.append(time.time() - start)
+        await asyncio.sleep(0.2)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--user", nargs="+", required=True)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--topics", default="memory, learning")
+    args = parser.parse_args()
+    if len(args.user) < args.concurrency:
+        print(
+            f"warning: {args.concurrency} generations over {len(args.user)} users, generations of the same "
+            "user run one after another unless the server's EXAM_MAX_PER_USER is raised"
+        )
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        stop = asyncio.Event()
+        latencies = []
+        probe_task = asyncio.create_task(probe(session, args.url, stop, latencies))
+
+        start = time.time()
+        results = await asyncio.gather(
+            *[create_exam(session, args.url, args.user[i % len(args.user)], args.topics) for i in range(args.concurrency)]
+        )
+        wall_time = time.time() - start
+        stop.set()
+        await probe_task
+
+    durations = [duration for _, duration in results]
+    print(f"statuses: {[status for status, _ in results]}")
+    print(f"exam generations: wall {wall_time:.1f}s, slowest {max(durations):.1f}s, sum {sum(durations):.1f}s")
+    if latencies:
+        latencies.sort()
+        print(
+            f"probe latency over {len(latencies)} requests: "
+            f"median {latencies[len(latencies) // 2] * 1000:.0f}ms, max {latencies[-1] * 1000:.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
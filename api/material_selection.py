@@ -0,0 +1,109 @@
+import heapq
+import os
+import time
+import metrics
+from lexical_ranker import BM25
+from text_extraction import can_extract, iter_text
+
+# Turns course materials into text locally and keeps only the chunks most
+# relevant to the requested topics, up to MATERIALS_TOKEN_BUDGET tokens, so
+# the assistant reads a small selection instead of whole pdfs and slide
+# decks. Files are extracted once and streamed: every chunk is scored against
+# the chunks seen so far and only the best candidates' text is kept, in a
+# heap a few times the size of the budget, so no file's full text is held in
+# memory. The candidates are ranked again once every chunk has been seen.
+# Files that can't be read locally are passed through unchanged. The
+# selection is returned as SELECTED_FILENAME, which the exam maker puts into
+# the thread's message rather than uploading.
+
+MATERIALS_SELECTION_ENABLED = os.getenv("MATERIALS_SELECTION_ENABLED", "1") == "1"
+MATERIALS_TOKEN_BUDGET = int(os.getenv("MATERIALS_TOKEN_BUDGET", "20000"))
+MATERIALS_CHUNK_WORDS = int(os.getenv("MATERIALS_CHUNK_WORDS", "300"))
+# Chunks kept as candidates, as a multiple of the chunks that fit the budget
+MATERIALS_CANDIDATE_FACTOR = int(os.getenv("MATERIALS_CANDIDATE_FACTOR", "3"))
+SELECTED_FILENAME = "course_materials.txt"
+
+
+def estimate_tokens(words):
+    return words * 4 // 3
+
+
+def iter_chunks(filename, content, chunk_words=MATERIALS_CHUNK_WORDS):
+    words = []
+    for piece in iter_text(filename, content):
+        words.extend(piece.split())
+        while len(words) >= chunk_words:
+            yield " ".join(words[:chunk_words])
+            words = words[chunk_words:]
+    if words:
+        yield " ".join(words)
+
+
+# files are (filename, bytes) pairs, returns the same with every readable file
+# replaced by a single file of their selected chunks
+def select_materials(files, class_name, topics, token_budget=MATERIALS_TOKEN_BUDGET):
+    if not MATERIALS_SELECTION_ENABLED:
+        return files
+    readable = [i for i, (filename, _) in enumerate(files) if can_extract(filename)]
+    if not readable:
+        return files
+    start = time.time()
+
+    scorer = BM25(topics if topics else class_name or "")
+    capacity = MATERIALS_CANDIDATE_FACTOR * max(1, token_budget // estimate_tokens(MATERIALS_CHUNK_WORDS))
+    # (score so far, -index, index, file, words, text), the worst candidate
+    # first, later chunks go first among equal scores
+    candidates = []
+    extracted = set()
+    source_words = 0
+    for i in readable:
+        filename, content = files[i]
+        for chunk in iter_chunks(filename, content):
+            j = scorer.add(chunk)
+            words = len(chunk.split())
+            source_words += words
+            extracted.add(i)
+            candidate = (scorer.score(j), -j, j, i, words, chunk)
+            if len(candidates) < capacity:
+                heapq.heappush(candidates, candidate)
+            elif candidate > candidates[0]:
+                heapq.heapreplace(candidates, candidate)
+    if not candidates:
+        return files
+
+    # Best candidates by their final score first, earlier chunks first among
+    # equal scores
+    statistics = scorer.statistics()
+    ranked = sorted(candidates, key=lambda candidate: (-scorer.score(candidate[2], statistics), candidate[2]))
+    selected = []
+    used = 0
+    for candidate in ranked:
+        tokens = estimate_tokens(candidate[4])
+        if used + tokens > token_budget:
+            continue
+        selected.append(candidate)
+        used += tokens
+
+    # Selected chunks in document order, gaps between them marked
+    sections = []
+    parts = []
+    previous = None
+    for _, _, j, i, _, chunk in sorted(selected, key=lambda candidate: candidate[2]):
+        if previous is not None and i != previous[1]:
+            sections.append(f"From {files[previous[1]][0]}:\n" + "\n".join(parts))
+            parts = []
+        elif previous is not None and j != previous[0] + 1:
+            parts.append("...")
+        parts.append(chunk)
+        previous = (j, i)
+    if parts:
+        sections.append(f"From {files[previous[1]][0]}:\n" + "\n".join(parts))
+
+    metrics.observe("materials.source_tokens", estimate_tokens(source_words))
+    metrics.observe("materials.selected_tokens", used)
+    metrics.observe("materials.selection", time.time() - start)
+    # Scanned documents and other unreadable files still go up whole
+    others = [file for i, file in enumerate(files) if i not in extracted]
+    if not sections:
+        return others
+    return [(SELECTED_FILENAME, "\n\n".join(sections).encode("utf-8"))] + others
@@ -0,0 +1,41 @@
+import threading
+from collections import defaultdict
+
+# Process wide counters and timings, exposed through the /metrics endpoint
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        timing["count"] += 1
+        timing["total"] += value
+        timing["max"] = max(timing["max"], value)
+
+
+def snapshot(prefix=""):
+    with _lock:
+        counters = {k: v for k, v in _counters.items() if k.startswith(prefix)}
+        gauges = {k: v for k, v in _gauges.items() if k.startswith(prefix)}
+        timings = {
+            k: {**v, "avg": v["total"] / v["count"] if v["count"] else 0.0}
+            for k, v in _timings.items()
+            if k.startswith(prefix)
+        }
+    return {"counters": counters, "gauges": gauges, "timings": timings}
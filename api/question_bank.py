@@ -0,0 +1,158 @@
+import hashlib
+import os
+import random
+import re
+import threading
+from collections import OrderedDict, defaultdict
+import metrics
+from AnswerChecker import normalizeAnswer
+
+# Every question saved for a user and course is fingerprinted with MinHash so
+# near duplicates (reworded or reordered) of earlier questions are rejected
+# at generation time instead of sending past exams to the model. Signatures
+# are split into bands and indexed by band, so a lookup only compares the
+# exact shingle overlap of the few questions sharing a band.
+# Questions are only added once their exam is saved.
+
+# Jaccard similarity of word shingles at which questions count as the same
+QUESTION_BANK_SIMILARITY = float(os.getenv("QUESTION_BANK_SIMILARITY", "0.8"))
+# Short questions are only rejected when identical, templated stems like
+# "What is the capital of France?" differ in a single word
+QUESTION_BANK_MIN_SHINGLES = int(os.getenv("QUESTION_BANK_MIN_SHINGLES", "12"))
+QUESTION_BANK_MAX_BANKS = int(os.getenv("QUESTION_BANK_MAX_BANKS", "1000"))
+# 8 bands of 4 rows find nearly all pairs above 0.8 similarity as candidates
+PERMUTATIONS = 32
+ROWS_PER_BAND = 4
+MERSENNE_PRIME = (1 << 61) - 1
+random_state = random.Random(0)
+PERMUTATION_PARAMS = [
+    (random_state.randrange(1, MERSENNE_PRIME), random_state.randrange(0, MERSENNE_PRIME))
+    for _ in range(PERMUTATIONS)
+]
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", (text or "").lower()).split())
+
+
+def course_key(class_name, school):
+    return f"{normalize(school)}|{normalize(class_name)}"
+
+
+def shingles(text):
+    words = normalizeAnswer(text).split()
+    return set(words + [" ".join(words[i:i + 2]) for i in range(len(words) - 1)])
+
+
+# Returns the question's shingle hashes and their MinHash signature
+def fingerprint(text):
+    hashes = frozenset(int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big") for shingle in shingles(text))
+    values = hashes or [0]
+    signature = tuple(min((a * h + b) % MERSENNE_PRIME for h in values) for a, b in PERMUTATION_PARAMS)
+    return hashes, signature
+
+
+def bands(signature):
+    return [(i, signature[i:i + ROWS_PER_BAND]) for i in range(0, PERMUTATIONS, ROWS_PER_BAND)]
+
+
+def similarity(hashes, other):
+    return len(hashes & other) / len(hashes | other) if hashes or other else 1.0
+
+
+def is_similar(hashes, other):
+    if hashes and hashes == other:
+        return True
+    if min(len(hashes), len(other)) < QUESTION_BANK_MIN_SHINGLES:
+        return False
+    return similarity(hashes, other) >= QUESTION_BANK_SIMILARITY
+
+
+class QuestionBank:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = defaultdict(list)
+        self.size = 0
+
+    def find(self, hashes, signature):
+        with self.lock:
+            for band in bands(signature):
+                for other in self.index.get(band, []):
+                    if is_similar(hashes, other):
+                        return True
+        return False
+
+    def add(self, text):
+        hashes, signature = fingerprint(text)
+        with self.lock:
+            for band in bands(signature):
+                self.index[band].append(hashes)
+            self.size += 1
+
+    # Checks the questions of one generation against the bank and each
+    # other without adding them, they are added when the exam is saved
+    def generation(self):
+        return GenerationCheck(self)
+
+
+class GenerationCheck:
+    def __init__(self, bank):
+        self.bank = bank
+        self.lock = threading.Lock()
+        self.accepted = []
+
+    def is_duplicate(self, question):
+        hashes, signature = fingerprint(question["question"])
+        if self.bank.find(hashes, signature):
+            metrics.incr("question_bank.duplicates")
+            return True
+        with self.lock:
+            if any(is_similar(hashes, other) for other in self.accepted):
+                metrics.incr("question_bank.duplicates")
+                return True
+            self.accepted.append(hashes)
+        return False
+
+
+class QuestionBanks:
+    def __init__(self, max_banks=QUESTION_BANK_MAX_BANKS):
+        self.max_banks = max_banks
+        self.banks = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the bank for a user's course, building it from the user's saved
+    # exams the first time. Exams saved before courses were recorded count for
+    # every course.
+    def get(self, user_id, class_name, school, past_exams):
+        key = (user_id, course_key(class_name, school))
+        with self.lock:
+            bank = self.banks.get(key)
+            if bank is not None:
+                self.banks.move_to_end(key)
+                metrics.incr("question_bank.hits")
+                return bank
+
+        bank = QuestionBank()
+        for exam in past_exams or []:
+            if exam.get("course", key[1]) != key[1]:
+                continue
+            for question in exam.get("questions", []):
+                bank.add(question["question"])
+        metrics.incr("question_bank.builds")
+
+        with self.lock:
+            # Another request may have built it meanwhile
+            bank = self.banks.setdefault(key, bank)
+            self.banks.move_to_end(key)
+            while len(self.banks) > self.max_banks:
+                self.banks.popitem(last=False)
+        return bank
+
+    # Adds the questions of a saved exam to the user's bank if it is already
+    # built, otherwise they are picked up from the saved exams when it is built
+    def record(self, user_id, course, questions):
+        with self.lock:
+            bank = self.banks.get((user_id, course))
+        if bank is not None:
+            for question in questions:
+                bank.add(question["question"])
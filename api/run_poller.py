@@ -0,0 +1,178 @@
+import os
+import random
+import time
+import metrics
+import llm_gateway
+
+# Drives an assistant run to completion, answering tool calls along the way.
+# Runs are polled with jittered exponential backoff, or followed through the
+# streaming runs API when RUN_MODE=stream. A run is cancelled early once the
+# caller's should_stop() returns True.
+
+RUN_MODE = os.getenv("RUN_MODE", "poll")
+RUN_POLL_INITIAL_INTERVAL = float(os.getenv("RUN_POLL_INITIAL_INTERVAL", "0.25"))
+RUN_POLL_MAX_INTERVAL = float(os.getenv("RUN_POLL_MAX_INTERVAL", "2.0"))
+RUN_POLL_BACKOFF = float(os.getenv("RUN_POLL_BACKOFF", "1.5"))
+# Runs taking longer than this in total are cancelled
+RUN_MAX_WAIT = float(os.getenv("RUN_MAX_WAIT", "600"))
+
+ACTIVE_STATUSES = ["queued", "in_progress"]
+
+
+class RunTimeoutError(Exception):
+    pass
+
+
+# Records how many polls a run took and how long it spent in each status
+class RunStats:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.polls = 0
+        self.status = None
+        self.status_since = self.start
+
+    def track(self, status):
+        if status == self.status:
+            return
+        now = time.time()
+        if self.status is not None:
+            metrics.observe(f"runs.{self.name}.status.{self.status}", now - self.status_since)
+        self.status = status
+        self.status_since = now
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def finish(self):
+        self.track(None)
+        metrics.incr(f"runs.{self.name}.runs")
+        metrics.observe(f"runs.{self.name}.polls", self.polls)
+        metrics.observe(f"runs.{self.name}.duration", self.elapsed())
+
+
+def request_cancel(client, thread_id, run_id):
+    try:
+        llm_gateway.call("assistants", client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        print(f"Failed to cancel run {run_id}: {e}")
+
+
+def stop_run(client, thread_id, run, stats):
+    request_cancel(client, thread_id, run.id)
+    metrics.incr(f"runs.{stats.name}.stopped")
+    stats.finish()
+    return run
+
+
+def cancel_run(client, thread_id, run_id, stats):
+    stats.finish()
+    metrics.incr(f"runs.{stats.name}.timeouts")
+    request_cancel(client, thread_id, run_id)
+    raise RunTimeoutError(f"Run {run_id} did not finish within {RUN_MAX_WAIT} seconds")
+
+
+# Creating a run and submitting tool outputs make the assistant's model do
+# work, so they count against that model's budget. What they reserved is
+# settled against the run's usage once it finishes.
+def poll_run(client, thread_id, assistant_id, handle_tool_calls, name, model, should_stop=None):
+    stats = RunStats(name)
+    reserved = llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE
+    run = llm_gateway.call(
+        model,
+        client.beta.threads.runs.create,
+        estimated_tokens=reserved,
+        idempotent=False,
+        thread_id=thread_id,
+        assistant_id=assistant_id
+    )
+    interval = RUN_POLL_INITIAL_INTERVAL
+    while True:
+        stats.track(run.status)
+        if should_stop and run.status in ACTIVE_STATUSES + ["requires_action"] and should_stop():
+            return stop_run(client, thread_id, run, stats)
+        if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
+            toolOutputs = handle_tool_calls(run.required_action.submit_tool_outputs.tool_calls)
+            if should_stop and should_stop():
+                return stop_run(client, thread_id, run, stats)
+            run = llm_gateway.call(
+                model,
+                client.beta.threads.runs.submit_tool_outputs,
+                estimated_tokens=llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE,
+                idempotent=False,
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=toolOutputs
+            )
+            reserved += llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE
+            # The run picks up right after tool outputs, so poll quickly again
+            interval = RUN_POLL_INITIAL_INTERVAL
+            continue
+        if run.status not in ACTIVE_STATUSES:
+            break
+        if stats.elapsed() > RUN_MAX_WAIT:
+            cancel_run(client, thread_id, run.id, stats)
+
+        time.sleep(random.uniform(interval / 2, interval))
+        interval = min(RUN_POLL_MAX_INTERVAL, interval * RUN_POLL_BACKOFF)
+        run = llm_gateway.call(
+            "assistants",
+            client.beta.threads.runs.retrieve,
+            thread_id=thread_id,
+            run_id=run.id
+        )
+        stats.polls += 1
+
+    stats.finish()
+    llm_gateway.settle(model, reserved, run)
+    return run
+
+
+def is_run_event(event):
+    return event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step.")
+
+
+def stream_run(client, thread_id, assistant_id, handle_tool_calls, name, model, should_stop=None):
+    stats = RunStats(name)
+    run = None
+    reserved = llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE
+    llm_gateway.reserve(model, reserved)
+    manager = client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id
+    )
+    while manager is not None:
+        with manager as stream:
+            manager = None
+            for event in stream:
+                if not is_run_event(event):
+                    continue
+                run = event.data
+                stats.track(run.status)
+                if should_stop and run.status in ACTIVE_STATUSES + ["requires_action"] and should_stop():
+                    return stop_run(client, thread_id, run, stats)
+                if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
+                    toolOutputs = handle_tool_calls(run.required_action.submit_tool_outputs.tool_calls)
+                    if should_stop and should_stop():
+                        return stop_run(client, thread_id, run, stats)
+                    llm_gateway.reserve(model, llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE)
+                    reserved += llm_gateway.LLM_DEFAULT_TOKEN_ESTIMATE
+                    manager = client.beta.threads.runs.submit_tool_outputs_stream(
+                        thread_id=thread_id,
+                        run_id=run.id,
+                        tool_outputs=toolOutputs
+                    )
+                    break
+                if stats.elapsed() > RUN_MAX_WAIT:
+                    cancel_run(client, thread_id, run.id, stats)
+
+    stats.finish()
+    if run is not None:
+        llm_gateway.settle(model, reserved, run)
+    return run
+
+
+def execute_run(client, thread_id, assistant_id, handle_tool_calls, name, model, mode=None, should_stop=None):
+    if (mode or RUN_MODE) == "stream":
+        return stream_run(client, thread_id, assistant_id, handle_tool_calls, name, model, should_stop)
+    return poll_run(client, thread_id, assistant_id, handle_tool_calls, name, model, should_stop)
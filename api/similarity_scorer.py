@@ -0,0 +1,62 @@
+import os
+import zlib
+import numpy as np
+from AnswerChecker import normalizeAnswer
+
+# Local lexical similarity between student answers and reference answers.
+# Answers are hashed into character n-gram and word vectors so a whole quiz
+# is scored with a single matrix operation and no model call.
+
+SIMILARITY_DIMENSIONS = int(os.getenv("GRADING_SIMILARITY_DIMENSIONS", "4096"))
+# Answers scoring at least this are accepted without the model
+SIMILARITY_ACCEPT_THRESHOLD = float(os.getenv("GRADING_SIMILARITY_ACCEPT", "0.95"))
+# Answers scoring at most this are rejected without the model. Off by default
+# since correct answers can share no n-grams with the reference ("three" and
+# "3", synonyms, other valid examples), set it from calibrate_similarity.py.
+SIMILARITY_REJECT_THRESHOLD = float(os.getenv("GRADING_SIMILARITY_REJECT", "-1"))
+NGRAM_SIZES = (3, 4, 5)
+
+
+def features(text):
+    normalized = normalizeAnswer(text)
+    words = normalized.split()
+    grams = ["w:" + word for word in words]
+    for word in words:
+        padded = f" {word} "
+        for n in NGRAM_SIZES:
+            grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+def vectorize(texts, dimensions=SIMILARITY_DIMENSIONS):
+    matrix = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for gram in features(text):
+            # crc32 rather than hash() so vectors are stable across processes
+            matrix[row, zlib.crc32(gram.encode("utf-8")) % dimensions] += 1.0
+    # Sublinear term frequency, then scale every row to unit length
+    np.log1p(matrix, out=matrix)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# Cosine similarity of answers[i] with references[i] for every i
+def score_pairs(answers, references):
+    if len(answers) == 0:
+        return np.zeros(0, dtype=np.float32)
+    vectors = vectorize(list(answers) + list(references))
+    return np.einsum("ij,ij->i", vectors[: len(answers)], vectors[len(answers):])
+
+
+# Returns True (clearly correct), False (clearly wrong) or None per score
+def classify(scores, accept=SIMILARITY_ACCEPT_THRESHOLD, reject=SIMILARITY_REJECT_THRESHOLD):
+    verdicts = []
+    for score in scores:
+        if score >= accept:
+            verdicts.append(True)
+        elif score <= reject:
+            verdicts.append(False)
+        else:
+            verdicts.append(None)
+    return verdicts
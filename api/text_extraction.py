@@ -0,0 +1,87 @@
+import io
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from pypdf import PdfReader
+
+# Local text extraction for course materials so they can be ranked and sent
+# to the model as text instead of whole files. iter_text yields a file's text
+# a page, slide or paragraph at a time so large files are never held as one
+# string. Formats it can't read (.doc, .ppt, scanned pdfs) yield nothing and
+# extract_text returns None for them so callers can fall back to uploading
+# the file.
+
+TEXT_EXTENSIONS = (".txt", ".md", ".csv")
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DRAWING_NAMESPACE = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+
+def extension(filename):
+    return os.path.splitext(filename.lower())[1]
+
+
+def iter_plain(content):
+    for line in io.TextIOWrapper(io.BytesIO(content), encoding="utf-8", errors="ignore"):
+        yield line
+
+
+def iter_pdf(content):
+    reader = PdfReader(io.BytesIO(content))
+    for page in reader.pages:
+        yield (page.extract_text() or "") + "\n\n"
+
+
+def iter_docx(content):
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        with archive.open("word/document.xml") as document:
+            for _, element in ET.iterparse(document):
+                if element.tag == f"{WORD_NAMESPACE}p":
+                    yield "".join(node.text or "" for node in element.iter(f"{WORD_NAMESPACE}t")) + "\n"
+                    element.clear()
+
+
+def slide_number(name):
+    return int(re.search(r"(\d+)\.xml$", name).group(1))
+
+
+def iter_pptx(content):
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        names = [name for name in archive.namelist() if re.match(r"ppt/slides/slide\d+\.xml$", name)]
+        for name in sorted(names, key=slide_number):
+            root = ET.fromstring(archive.read(name))
+            lines = []
+            for paragraph in root.iter(f"{DRAWING_NAMESPACE}p"):
+                line = "".join(node.text or "" for node in paragraph.iter(f"{DRAWING_NAMESPACE}t"))
+                if line.strip():
+                    lines.append(line)
+            yield f"Slide {slide_number(name)}:\n" + "\n".join(lines) + "\n\n"
+
+
+EXTRACTORS = {
+    ".pdf": iter_pdf,
+    ".docx": iter_docx,
+    ".pptx": iter_pptx,
+}
+for text_extension in TEXT_EXTENSIONS:
+    EXTRACTORS[text_extension] = iter_plain
+
+
+def can_extract(filename):
+    return extension(filename) in EXTRACTORS
+
+
+def iter_text(filename, content):
+    if not can_extract(filename):
+        return
+    try:
+        for piece in EXTRACTORS[extension(filename)](content):
+            yield re.sub(r"[ \t]+", " ", piece)
+    except Exception as e:
+        print(f"Failed to extract text from {filename}: {e}")
+
+
+def extract_text(filename, content):
+    text = "".join(iter_text(filename, content)).strip()
+    # Nothing readable, most likely a scanned document
+    return text if text else None
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import llm_gateway
+from question_bank import course_key
+
+# One vector store per course so materials are chunked and embedded once and
+# every later exam for the course searches the same store. Files a store
+# doesn't have yet are attached to the request's thread as before and
+# ingested into the store in the background, so ingestion is never on the
+# critical path. Stores idle for VECTOR_STORE_MAX_IDLE_DAYS, past
+# VECTOR_STORE_MAX_STORES or past VECTOR_STORE_MAX_BYTES in total are
+# deleted, least recently used first, unless a thread still searches them.
+
+VECTOR_STORES_ENABLED = os.getenv("VECTOR_STORES_ENABLED", "1") == "1"
+VECTOR_STORE_MAX_STORES = int(os.getenv("VECTOR_STORE_MAX_STORES", "50"))
+VECTOR_STORE_MAX_BYTES = int(os.getenv("VECTOR_STORE_MAX_BYTES", str(1024 ** 3)))
+VECTOR_STORE_MAX_IDLE_DAYS = int(os.getenv("VECTOR_STORE_MAX_IDLE_DAYS", "7"))
+# Evicted locally an hour before OpenAI expires the idle store
+MAX_IDLE = VECTOR_STORE_MAX_IDLE_DAYS * 24 * 3600 - 3600
+
+ingest_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingest")
+
+
+class VectorStoreManager:
+    def __init__(self, client):
+        self.client = client
+        self.stores = OrderedDict()
+        self.lock = threading.Lock()
+        # Threads currently searching each vector store id
+        self.in_use = Counter()
+
+    # Returns the course's vector store id (None while it has nothing
+    # searchable yet) and the file ids that still have to be attached to the
+    # thread. owner keeps stores of user uploads private to that user, fetched
+    # public materials are shared by everyone taking the course. A returned
+    # vector store id must be given to release once its thread is done.
+    def resources_for(self, class_name, school, file_ids, owner=None):
+        if not VECTOR_STORES_ENABLED or not file_ids:
+            return None, file_ids
+        key = (course_key(class_name, school), owner)
+        with self.lock:
+            store = self.stores.get(key)
+            if store is None:
+                store = self.stores[key] = {
+                    "vector_store_id": None,
+                    "ready": set(),
+                    "ingesting": set(),
+                    "usage_bytes": 0,
+                    "last_used": time.time(),
+                    # Held while creating the store so concurrent ingests
+                    # don't each create one
+                    "create_lock": threading.Lock(),
+                }
+            self.stores.move_to_end(key)
+            store["last_used"] = time.time()
+            pending = [file_id for file_id in file_ids if file_id not in store["ready"]]
+            new = [file_id for file_id in pending if file_id not in store["ingesting"]]
+            store["ingesting"].update(new)
+            vector_store_id = store["vector_store_id"] if store["ready"] else None
+            if vector_store_id:
+                self.in_use[vector_store_id] += 1
+
+        if new:
+            ingest_pool.submit(self.ingest, key, store, new)
+        metrics.incr("vector_stores.hits" if vector_store_id and not pending else "vector_stores.misses")
+        self.evict()
+        return vector_store_id, pending
+
+    def release(self, vector_store_id):
+        if not vector_store_id:
+            return
+        with self.lock:
+            self.in_use[vector_store_id] -= 1
+            if self.in_use[vector_store_id] <= 0:
+                del self.in_use[vector_store_id]
+
+    def ingest(self, key, store, file_ids):
+        start = time.time()
+        try:
+            with store["create_lock"]:
+                if store["vector_store_id"] is None:
+                    vector_store = llm_gateway.call(
+                        "assistants",
+                        self.client.vector_stores.create,
+                        idempotent=False,
+                        name=f"{key[0]} materials",
+                        expires_after={"anchor": "last_active_at", "days": VECTOR_STORE_MAX_IDLE_DAYS},
+                    )
+                    store["vector_store_id"] = vector_store.id
+            batch = llm_gateway.call(
+                "assistants",
+                self.client.vector_stores.file_batches.create_and_poll,
+                vector_store_id=store["vector_store_id"],
+                file_ids=file_ids,
+            )
+            vector_store = llm_gateway.call("assistants", self.client.vector_stores.retrieve, store["vector_store_id"])
+            with self.lock:
+                if batch.status == "completed":
+                    store["ready"].update(file_ids)
+                store["usage_bytes"] = vector_store.usage_bytes
+            metrics.observe("vector_stores.ingest", time.time() - start)
+        except Exception as e:
+            print(f"Failed to ingest files into the vector store for {key[0]}: {e}")
+            metrics.incr("vector_stores.ingest_failures")
+        finally:
+            with self.lock:
+                store["ingesting"].difference_update(file_ids)
+
+    def evict(self):
+        now = time.time()
+        evicted = []
+        with self.lock:
+            total = sum(store["usage_bytes"] for store in self.stores.values())
+            for key, store in list(self.stores.items()):
+                idle = now - store["last_used"] > MAX_IDLE
+                over = len(self.stores) > VECTOR_STORE_MAX_STORES or total > VECTOR_STORE_MAX_BYTES
+                if not idle and not over:
+                    break
+                if store["ingesting"] or store["vector_store_id"] in self.in_use:
+                    continue
+                del self.stores[key]
+                total -= store["usage_bytes"]
+                if store["vector_store_id"]:
+                    evicted.append(store["vector_store_id"])
+        for vector_store_id in evicted:
+            metrics.incr("vector_stores.evictions")
+            ingest_pool.submit(self.delete, vector_store_id)
+
+    def delete(self, vector_store_id):
+        try:
+            llm_gateway.call("assistants", self.client.vector_stores.delete, vector_store_id)
+        except Exception as e:
+            print(f"Failed to delete vector store {vector_store_id}: {e}")
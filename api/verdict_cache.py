@@ -0,0 +1,164 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import boto3
+import metrics
+
+# Cache of open-ended grading verdicts keyed by question fingerprint and
+# normalized answer. The in-process tier is always on, the sqlite and
+# DynamoDB tiers are enabled by setting GRADING_CACHE_PATH / GRADING_CACHE_TABLE.
+
+GRADING_CACHE_TTL = int(os.getenv("GRADING_CACHE_TTL", str(7 * 24 * 3600)))
+GRADING_CACHE_MAX_ENTRIES = int(os.getenv("GRADING_CACHE_MAX_ENTRIES", "10000"))
+GRADING_CACHE_PATH = os.getenv("GRADING_CACHE_PATH")
+GRADING_CACHE_TABLE = os.getenv("GRADING_CACHE_TABLE")
+
+
+class MemoryTier:
+    name = "memory"
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DiskTier:
+    name = "disk"
+
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, used_at REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM verdicts WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.conn.execute("DELETE FROM verdicts WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE verdicts SET used_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now),
+            )
+            self.conn.execute("DELETE FROM verdicts WHERE expires_at < ?", (now,))
+            # Evict the least recently used rows over the size bound
+            self.conn.execute(
+                "DELETE FROM verdicts WHERE key IN (SELECT key FROM verdicts ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+
+class DynamoTier:
+    name = "dynamodb"
+
+    # The table needs a "key" partition key and TTL enabled on "expires_at"
+    def __init__(self, table_name, ttl):
+        self.ttl = ttl
+        session = boto3.Session(
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        )
+        self.table = session.resource("dynamodb", region_name="us-east-1").Table(table_name)
+
+    def get(self, key):
+        item = self.table.get_item(Key={"key": key}).get("Item")
+        # DynamoDB removes expired items lazily, so check the expiry here too
+        if item is None or int(item["expires_at"]) < time.time():
+            return None
+        return json.loads(item["value"])
+
+    def put(self, key, value):
+        self.table.put_item(
+            Item={
+                "key": key,
+                "value": json.dumps(value),
+                "expires_at": int(time.time() + self.ttl),
+            }
+        )
+
+
+class VerdictCache:
+    def __init__(self, ttl=GRADING_CACHE_TTL, max_entries=GRADING_CACHE_MAX_ENTRIES, path=GRADING_CACHE_PATH, table_name=GRADING_CACHE_TABLE):
+        self.memory = MemoryTier(max_entries, ttl)
+        self.persistent = []
+        if path:
+            self.persistent.append(DiskTier(path, max_entries, ttl))
+        if table_name:
+            self.persistent.append(DynamoTier(table_name, ttl))
+
+    def get_memory(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            metrics.incr("grading_cache.hits.memory")
+        return value
+
+    def get(self, key):
+        value = self.get_memory(key)
+        if value is not None:
+            return value
+        for tier in self.persistent:
+            try:
+                value = tier.get(key)
+            except Exception as e:
+                print(f"Grading cache {tier.name} lookup failed: {e}")
+                continue
+            if value is not None:
+                metrics.incr(f"grading_cache.hits.{tier.name}")
+                self.memory.put(key, value)
+                return value
+        metrics.incr("grading_cache.misses")
+        return None
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        for tier in self.persistent:
+            try:
+                tier.put(key, value)
+            except Exception as e:
+                print(f"Grading cache {tier.name} write failed: {e}")
+
+    def stats(self):
+        return metrics.snapshot("grading_cache.")["counters"]
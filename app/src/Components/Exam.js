@@ -1,5 +1,5 @@
 // src/Components/Exam.js
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import Question from "./Question";
 import "./Exam.css"; // Import the corresponding CSS file
 
@@ -24,18 +24,47 @@ function Exam({ selectedExam, examQuestions, exams, username, tier }) {
   // State for submission loading
   const [isSubmitting, setIsSubmitting] = useState(false);
 
+  // Pending background grading timers per question
+  const gradeTimers = useRef({});
+
+  // Grade open-ended answers in the background once the student stops typing
+  // so submitting only has to collect the verdicts
+  const gradeAnswerInBackground = (questionIndex, answer) => {
+    clearTimeout(gradeTimers.current[questionIndex]);
+    if (questions[questionIndex]?.type !== "oe" || answer.trim() === "") {
+      return;
+    }
+    gradeTimers.current[questionIndex] = setTimeout(() => {
+      fetch(`${process.env.REACT_APP_API_URL}/grade_answer`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+          username: username,
+          exam_id: selectedExam,
+          question_index: questionIndex,
+          answer: answer,
+        }),
+      }).catch((error) => console.error("Error grading answer:", error));
+    }, 1500);
+  };
+
   // Handle answer changes from Question components
   const handleAnswerChange = (questionIndex, answer) => {
     setUserAnswers((prevAnswers) => ({
       ...prevAnswers,
       [questionIndex]: answer,
     }));
+    gradeAnswerInBackground(questionIndex, answer);
   };
 
   // Reset userAnswers and result when selectedExam changes
   useEffect(() => {
     // set answers as blank for all questions
     setUserAnswers({ ...questions.map((_, index) => "") });
+    Object.values(gradeTimers.current).forEach(clearTimeout);
+    gradeTimers.current = {};
     setResult(null);
     setIsSubmitting(false);
   }, [selectedExam]);
@@ -53,7 +82,7 @@ function Exam({ selectedExam, examQuestions, exams, username, tier }) {
     setResult(null); // Reset previous result
 
     try {
-      const response = await fetch(`${process.env.REACT_APP_API_URL}/grade_quiz`, {
+      const response = await fetch(`${process.env.REACT_APP_API_URL}/grade_quiz_stream`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -65,10 +94,33 @@ function Exam({ selectedExam, examQuestions, exams, username, tier }) {
         throw new Error("Failed to grade quiz");
       }
 
-      const data = await response.json();
-
-      // Assume the API returns data like { score: number, total: number, details: [...] }
-      setResult(data);
+      // The API streams one JSON line per graded question like
+      // { index: number, detail: {...} } and ends with { score: number, total: number }
+      const details = [];
+      const handleFrame = (frame) => {
+        if (frame.score !== undefined) {
+          setResult((prevResult) => ({ ...prevResult, score: frame.score, total: frame.total }));
+        } else if (frame.index !== undefined && (tier === "gold" || tier === "diamond")) {
+          details[frame.index] = frame.detail;
+          setResult((prevResult) => ({ ...prevResult, details: [...details] }));
+        }
+      };
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+          break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        lines
+          .filter((line) => line.trim() !== "")
+          .forEach((line) => handleFrame(JSON.parse(line)));
+      }
     } catch (error) {
       console.error("Error submitting exam:", error);
       alert("Failed to submit exam. Please try again.");
@@ -100,7 +152,7 @@ function Exam({ selectedExam, examQuestions, exams, username, tier }) {
           {isSubmitting ? "Submitting..." : "Submit"}
         </button>
       )}
-      {result && (
+      {result && result.score !== undefined && (
         <div className="result-summary">
           <h2>
             Score: {result.score} / {result.total}
@@ -108,7 +160,7 @@ function Exam({ selectedExam, examQuestions, exams, username, tier }) {
         </div>
       )}
       {/* If user is free tell them to upgrade to see questions answers */}
-      {result && tier === "free" && (
+      {result && result.score !== undefined && tier === "free" && (
         <div className="upgrade-message">
           <p>
             Upgrade to see the correct answers for each question.